@@ -0,0 +1,6 @@
+# -*- coding: utf-8 -*-
+
+"""Benchmarks for putshebang.
+
+Run them with :code:`python -m benchmarks --help`.
+"""
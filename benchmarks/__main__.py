@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+
+"""Runs the benchmarks, saves the results and compares them against an older run."""
+from __future__ import print_function
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import putshebang
+from putshebang import cli, iter_shebangs, shebang, which, ShebangedFile
+from putshebang.shebangs import _extension_of
+
+from benchmarks.fixtures import make_path_farm, make_link_chains, make_tree
+
+FORMAT_VERSION = 1
+
+
+@contextlib.contextmanager
+def _quiet():
+    """Throws away whatever is printed, the benchmarks don't measure the terminal."""
+    with open(os.devnull, 'w') as devnull:
+        stdout, stderr = sys.stdout, sys.stderr
+        sys.stdout = sys.stderr = devnull
+        try:
+            yield
+        finally:
+            sys.stdout, sys.stderr = stdout, stderr
+
+
+def measure(func, repeat, ops=1, setup=None):
+    """Runs `func' `repeat' times, plus once more under tracemalloc for the peak memory.
+
+    :param func: the thing to measure
+    :param repeat: number of timed runs, the median and the best of them are reported
+    :param ops: number of operations `func' does per run, used for the throughput
+    :param setup: called before every run and not measured
+    :return: a dict of the results
+    """
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        with _quiet():
+            func()
+        times.append(time.perf_counter() - start)
+
+    # tracing slows everything down, so it has its own run
+    if setup is not None:
+        setup()
+    tracemalloc.start()
+    with _quiet():
+        func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    times.sort()
+    median = times[len(times) // 2]
+    return {
+        "median": median,
+        "best": times[0],
+        "ops_per_sec": ops / median if median else None,
+        "peak_kib": peak // 1024,
+    }
+
+
+def run(args):
+    """Builds the fixtures and runs every benchmark over them."""
+    root = tempfile.mkdtemp(prefix="putshebang-bench-")
+    old_path = os.environ.get("PATH")
+    results = {}
+    try:
+        names = sorted({i["name"] for e in ShebangedFile.ALL_INTERS.values() for i in [e["default"]] + e["others"]})
+        dirs = make_path_farm(root, names, args.executables, args.dirs, args.seed)
+        links = make_link_chains(root, names)
+        os.environ["PATH"] = ":".join(dirs + [links])
+
+        def bench(name, func, ops=1, setup=None, repeat=args.repeat):
+            print("[-] %s" % name, file=sys.stderr)
+            results[name] = measure(func, repeat, ops, setup)
+
+        bench("which", lambda: which("python*"))
+        bench("extension_of", lambda: [_extension_of(n) for n in ("tool.py", "deploy.prod.py", "archive.tar.gz")],
+              ops=3)
+        for get_links in range(3):
+            bench("get_extension[links=%d]" % get_links,
+                  lambda: ShebangedFile.get_extension(file_name="file.py", get_versions=True, get_links=get_links))
+        # every run resolves, the memoized results have their own entry
+        bench("shebang", lambda: shebang("file.py"), setup=putshebang.clear_cache)
+        bench("shebang[miss]", lambda: shebang("file.php"), setup=putshebang.clear_cache)
+        bench("shebang[cached]", lambda: shebang("file.py"), setup=lambda: shebang("file.py"))
+        bench("iter_shebangs[first]", lambda: next(iter_shebangs("file.py"), None))
+        bench("print_known[tree]", lambda: ShebangedFile.print_known(0, 'tree'))
+
+        for n in args.files:
+            tree = os.path.join(root, "tree%d" % n)
+            box = {}
+
+            def build():
+                shutil.rmtree(tree, ignore_errors=True)
+                box["files"] = make_tree(tree, n, args.seed)
+
+            build()
+            files = box["files"]
+            bench("cli.main[%d files]" % n, lambda: cli.main(["-d"] + box["files"]), ops=n, setup=build, repeat=1)
+            # the second run has nothing left to do
+            bench("cli.main[%d files, no-op]" % n, lambda: cli.main(["-d"] + files), ops=n, repeat=1)
+    finally:
+        if old_path is None:
+            os.environ.pop("PATH", None)
+        else:
+            os.environ["PATH"] = old_path
+        shutil.rmtree(root, ignore_errors=True)
+
+    return {
+        "format": FORMAT_VERSION,
+        "meta": {
+            "putshebang": putshebang.__version__,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "params": {"executables": args.executables, "dirs": args.dirs, "files": args.files,
+                       "seed": args.seed, "repeat": args.repeat},
+        },
+        "results": results,
+    }
+
+
+def compare(old, new, threshold):
+    # type: (dict, dict, float) -> int
+    """Prints the difference between two runs.
+
+    :return: number of benchmarks that got slower by more than `threshold' (a ratio)
+    """
+    regressions = 0
+    if old["meta"]["params"] != new["meta"]["params"]:
+        print("[*] WARNING: the runs have different parameters, the comparison is meaningless", file=sys.stderr)
+
+    print("%-32s %12s %12s %8s" % ("benchmark", "old (s)", "new (s)", "change"))
+    for name, res in sorted(new["results"].items()):
+        if name not in old["results"]:
+            print("%-32s %12s %12.6f %8s" % (name, '-', res["median"], 'new'))
+            continue
+
+        before, after = old["results"][name]["median"], res["median"]
+        change = (after - before) / before if before else 0.
+        mark = ''
+        if change > threshold:
+            regressions += 1
+            mark = ' <-- regression'
+        print("%-32s %12.6f %12.6f %+7.1f%%%s" % (name, before, after, change * 100, mark))
+
+    return regressions
+
+
+def main(args_=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks", description="Benchmarks of putshebang.")
+    parser.add_argument("-o", "--output", metavar="FILE", help="save the results as json into FILE")
+    parser.add_argument("-c", "--compare", metavar="FILE",
+                        help="compare the results against an earlier run saved in FILE, "
+                             "the exit code is 1 if anything regressed")
+    parser.add_argument("-t", "--threshold", type=float, default=0.2,
+                        help="the slowdown ratio that counts as a regression; default is 0.2")
+    parser.add_argument("-r", "--repeat", type=int, default=5, help="runs of every benchmark; default is 5")
+    parser.add_argument("-e", "--executables", type=int, default=5000,
+                        help="number of executables on the fake PATH; default is 5000")
+    parser.add_argument("-d", "--dirs", type=int, default=8, help="number of PATH directories; default is 8")
+    parser.add_argument("-f", "--files", type=int, nargs='*', default=[10000],
+                        help="sizes of the file trees for the end-to-end runs; default is 10000")
+    parser.add_argument("-s", "--seed", type=int, default=0, help="seed of the fixtures; default is 0")
+    args = parser.parse_args(args_)
+
+    results = run(args)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            return 1 if compare(json.load(f), results, args.threshold) else 0
+
+    for name, res in sorted(results["results"].items()):
+        print("%-32s %12.6f s  %10s ops/s  %8d KiB" % (name, res["median"], "%.1f" % res["ops_per_sec"],
+                                                       res["peak_kib"]))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+
+"""Reproducible fixtures for the benchmarks.
+
+Everything here is generated from a seed, so two runs with the same parameters build the exact same trees.
+"""
+
+import os
+import random
+
+from typing import List
+
+# versions that are put in the interpreter farms, for every interpreter name in `langs.json'
+VERSIONS = ['', '2', '2.7', '3', '3.4', '3.5', '3.6', '3.7', '-3.8', '2017.04']
+
+EXTENSIONS = ['py', 'sh', 'rb', 'pl', 'js', 'lua', 'txt', '']
+
+SCRIPT = b"#!/bin/sh\nexit 0\n"
+
+
+def _executable(path, contents=SCRIPT):
+    with open(path, 'wb') as f:
+        f.write(contents)
+    os.chmod(path, 0o755)
+
+
+def make_path_farm(root, interpreters, n_executables=2000, n_dirs=8, seed=0):
+    # type: (str, List[str], int, int, int) -> List[str]
+    """Builds a fake PATH.
+
+    :param root: the directory to build the farm inside
+    :param interpreters: interpreter names to put in the farm, every one of them in all of `VERSIONS'
+    :param n_executables: number of unrelated executables, spread over all of the directories
+    :param n_dirs: number of PATH directories
+    :param seed: the seed of the random names
+    :return: the PATH directories, in order
+    """
+    rand = random.Random(seed)
+    dirs = [os.path.join(root, "bin%d" % i) for i in range(n_dirs)]
+    for d in dirs:
+        os.makedirs(d)
+
+    for i in range(n_executables):
+        name = "".join(rand.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(rand.randint(3, 12)))
+        _executable(os.path.join(rand.choice(dirs), "%s%d" % (name, i)))
+
+    # the interpreters live in a few of the directories, the way /usr/bin and /usr/local/bin both have some
+    for name in interpreters:
+        for version in VERSIONS:
+            path = os.path.join(rand.choice(dirs[:3]), name + version)
+            if not os.path.exists(path):
+                _executable(path)
+
+    return dirs
+
+
+def make_link_chains(root, interpreters, length=4):
+    # type: (str, List[str], int) -> str
+    """Builds a directory where every interpreter is a chain of `length' symlinks to a real file.
+
+    python -> python.1 -> python.2 -> ... -> python.real, that's what the `get_links' modes have to unwind.
+
+    :return: the directory of the chains
+    """
+    d = os.path.join(root, "links")
+    os.makedirs(d)
+    for name in interpreters:
+        real = os.path.join(d, name + ".real")
+        _executable(real)
+        target = real
+        for i in range(length, 0, -1):
+            link = os.path.join(d, "%s.%d" % (name, i))
+            os.symlink(target, link)
+            target = link
+        os.symlink(target, os.path.join(d, name))
+    return d
+
+
+def make_tree(root, n_files, seed=0, fanout=100, max_size=64 * 1024):
+    # type: (str, int, int, int, int) -> List[str]
+    """Builds a tree of `n_files' scripts of different extensions and sizes.
+
+    Sizes are log-uniform up to `max_size', a third of the files already have a shebang.
+
+    :return: the file names
+    """
+    rand = random.Random(seed)
+    files = []
+    for i in range(n_files):
+        d = os.path.join(root, "tree", "d%d" % (i // fanout // fanout), "d%d" % (i // fanout % fanout))
+        if i % fanout == 0:
+            os.makedirs(d)
+
+        ext = rand.choice(EXTENSIONS)
+        name = os.path.join(d, "f%d" % i + ("." + ext if ext else ''))
+        size = int(2 ** rand.uniform(4, max_size.bit_length() - 1))
+        head = b"#!/usr/bin/env x\n" if rand.random() < 1 / 3. else b''
+        with open(name, 'wb') as f:
+            f.write(head + (b"x = 1\n" * (size // 6 + 1))[:size])
+        files.append(name)
+
+    return files
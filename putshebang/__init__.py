@@ -1,19 +1,45 @@
 # -*- coding: utf-8 -*-
 
 """Top-level package for putshebang."""
+import os as _os
 
-from typing import List
+from typing import Dict, List
 
-from .shebangs import ShebangedFile, UnshebangedFile, ShebangNotFoundError, which, InterpreterPath, Interpreter
+from .shebangs import ShebangedFile, UnshebangedFile, BufferFile, ShebangNotFoundError, ConcurrentModificationError, \
+    which, iter_shebangs, InterpreterPath, Interpreter
+from .shebangs import _extension_of, _venv_of
+from ._discovery import Inventory
+from ._providers import ProviderIndex, Provider, register as register_provider
+from ._venv import VenvFinder
+from ._startup import StartupTimer
+from ._journal import Journal
+from ._lockfile import Lockfile
+from ._profiles import PROFILES, apply_profile
+from ._rewrite import RewriteTable
+from ._state import AuditState
+from ._cache import LRUCache as _LRUCache, path_fingerprint as _path_fingerprint
+from ._stats import Stats, stats
 
-__all__ = ["ShebangedFile", "UnshebangedFile", "InterpreterPath", "Interpreter", "ShebangNotFoundError", "which"]
+__all__ = ["ShebangedFile", "UnshebangedFile", "BufferFile", "InterpreterPath", "Interpreter", "ShebangNotFoundError",
+           "ConcurrentModificationError", "which", "iter_shebangs", "Stats", "stats", "Inventory", "ProviderIndex",
+           "Provider", "register_provider", "VenvFinder", "StartupTimer", "Journal", "Lockfile", "RewriteTable",
+           "AuditState", "PROFILES", "apply_profile"]
 __author__ = """Fady Adel"""
 __email__ = '2masadel@gmail.com'
 __version__ = '0.1.6'
 
+# results of `shebang', the misses are kept as well
+_cache = _LRUCache(maxsize=256)
 
-def shebang(file_name=None, interpreter=None, get_versions=False, get_links=0):
-    # type: (str, str, bool, int) -> List[str]
+
+def clear_cache():
+    # type: () -> None
+    """Forgets the results of `shebang', they're forgotten anyways when PATH or any of its directories change."""
+    _cache.clear()
+
+
+def shebang(file_name=None, interpreter=None, get_versions=False, get_links=0, use_cache=True):
+    # type: (str, str, bool, int, bool) -> List[str]
 
     """Get available shebangs associated with `file_name' or `interpreter'.
     :param file_name: the file name to get the extension from
@@ -28,12 +54,68 @@ def shebang(file_name=None, interpreter=None, get_versions=False, get_links=0):
                           1 means don't get links but get real paths even if they're not in PATHS
                           2 means same as 1 but exclude the ones that are not in PATH (that also means the ones already
                             exist (no multiple references for the same file))
+    :param use_cache: reuse the result of an earlier call with the same arguments (and the same PATH)
     :return: list of available shebangs on the system
     """
+    key = (_extension_of(file_name) if file_name else None, _venv_of(file_name), interpreter, get_versions, get_links,
+           _path_fingerprint())
+    if use_cache:
+        shebangs = _cache.get(key)
+        # a chmod -x changes neither PATH nor the mtimes in it
+        if shebangs is not None and all(_os.access(s[2:], _os.X_OK) for s in shebangs):
+            stats.count("cache_hits")
+            return list(shebangs)
+        stats.count("cache_misses")
+
     d = ShebangedFile.get_extension(file_name=file_name, interpreter=interpreter, get_versions=get_versions,
                                     get_links=get_links).interpreters
     all_paths = [str(p) for i in [l.all_paths for l in [d["default"] if d["default"] else []] + d["others"]] for p in i]
 
-    return list(map(lambda p: "#!{}".format(p), all_paths))
+    shebangs = list(map(lambda p: "#!{}".format(p), all_paths))
+    _cache.put(key, shebangs)
+    return list(shebangs)
+
+
+def shebang_buffer(name, contents, interpreter=None, env=False, env_args=None, overwrite=True, newline_count=1,
+                   check=False, flags=None):
+    # type: (str, str or bytes, str, bool, str, bool, int, bool, str) -> Dict
+    """Puts the shebang into `contents' as if they were the contents of the file `name', without touching the file.
+
+    Only finding the interpreter looks at the file system (and only until the first one is found, see
+    `iter_shebangs'), with `env' nothing does.
+
+    basic usage:
+        >>> result = shebang_buffer("file.py", "print(1)\\n")
+        >>> result["contents"], result["status"], result["interpreter"]
+        ('#!/usr/bin/python\\n\\nprint(1)\\n', 0, '/usr/bin/python')
+
+    :param name: the name of the file, only its extension is used
+    :param contents: the contents of the file, str or bytes (the result is of the same type)
+    :param interpreter: use this interpreter name rather than the default of the extension
+    :param env: use '#!/usr/bin/env NAME' as the shebang, see `ShebangedFile.env_shebang'
+    :param env_args: arguments to be passed to the interpreter with `env'
+    :param overwrite: overwrite a shebang pointing to a wrong interpreter
+    :param newline_count: number of newlines put after the shebang
+    :param check: only check the shebang, the contents are returned as they are
+    :param flags: put the flags of this profile (one of `PROFILES') after the interpreter, see `apply_profile'
+    :return: {'contents': the new contents, 'status': what `ShebangedFile.check_shebang' says about the given contents,
+              'interpreter': the chosen interpreter (the shebang without the '#!')}
+    """
+    if env:
+        line = ShebangedFile.env_shebang(file_name=name, interpreter=interpreter, args=env_args)
+    else:
+        # the best one, as the command line chooses it (`shebang' returns them sorted by their paths)
+        line = next(iter_shebangs(file_name=name, interpreter=interpreter), None)
+        if line is None:
+            raise ShebangNotFoundError("no interpreter for %r is found in this machine's PATH" % name)
+    if flags:
+        line = apply_profile(line, flags)
+
+    buf = BufferFile(name, contents)
+    sf = ShebangedFile(buf, shebang=line + "\n")
+    status = sf.check_shebang()
+    if not check:
+        sf.put_shebang(newline_count=newline_count, overwrite=overwrite)
+    return {"contents": buf.text(), "status": status, "interpreter": line[2:]}
 
-__all__.append("shebang")
+__all__.extend(["shebang", "clear_cache", "shebang_buffer"])
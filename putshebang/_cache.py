@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+
+"""caching of what's expensive to find out"""
+import os
+from collections import OrderedDict
+
+from typing import Hashable, Tuple
+
+from putshebang._discovery import Inventory, PathLister
+from putshebang._providers import ProviderIndex
+
+
+class LRUCache(object):
+    """A dict that forgets the least recently used keys once it holds more than `maxsize' of them."""
+
+    def __init__(self, maxsize=128):
+        # type: (int) -> None
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+
+    def get(self, key, default=None):
+        # type: (Hashable, ...) -> ...
+        try:
+            value = self._data.pop(key)
+        except KeyError:
+            return default
+        self._data[key] = value
+        return value
+
+    def put(self, key, value):
+        # type: (Hashable, ...) -> None
+        self._data.pop(key, None)
+        self._data[key] = value
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def clear(self):
+        # type: () -> None
+        self._data.clear()
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+
+def path_fingerprint():
+    # type: () -> Tuple
+    """Something that changes whenever what `which' finds might change.
+
+    That's the PATH itself plus the modification time of every directory in it (adding, removing or renaming an
+    executable changes the mtime of its directory) and the number of executables in it (a chmod doesn't change the
+    mtime), it costs a stat per directory (and per file that isn't executable) which is way less than listing them.
+    An active inventory is a fingerprint by itself, and the roots of the active provider index are a part of it.
+    """
+    if Inventory.current is not None:
+        return "inventory", Inventory.current
+
+    path = os.environ.get("PATH", os.defpath)
+    # the directories that don't answer aren't touched
+    mtimes = PathLister.current.fingerprint(path.split(":"))
+    if ProviderIndex.current is not None:
+        return path, mtimes, ProviderIndex.current, ProviderIndex.current.fingerprint()
+    return path, mtimes
@@ -0,0 +1,409 @@
+# -*- coding: utf-8 -*-
+
+"""snapshots of the executables on PATH"""
+import fnmatch
+import json
+import os
+import threading
+import time
+from collections import deque
+
+from typing import Callable, Dict, IO, List, Tuple
+
+from putshebang._stats import stats
+
+_clock = getattr(time, "monotonic", time.time)
+
+
+class Inventory(object):
+    """The executables found on PATH (and where the links among them point to), at some point of time.
+
+    When an inventory is activated, `which' and everything that uses it answers from the inventory, and the file system
+    isn't looked at anymore. That's how shebangs are resolved for a machine (or an image) other than this one:
+
+    basic usage:
+        >>> with open("image.json", "w") as f:
+        ...     Inventory.scan().dump(f)      # on the image
+        >>> with open("image.json") as f:
+        ...     Inventory.load(f).activate()  # anywhere else
+    """
+
+    FORMAT = 1
+
+    # the active inventory
+    current = None  # type: Inventory
+
+    def __init__(self, dirs, files, links=None, real_dirs=None):
+        # type: (List[str], Dict[str, List[str]], Dict[str, str], Dict[str, str]) -> None
+        """Constructor.
+
+        :param dirs: the PATH directories, in order
+        :param files: {directory: [names of the executables in it]}
+        :param links: {path of a link: its real path}
+        :param real_dirs: {directory: its real path}, for the directories that aren't real paths themselves
+        """
+        self.dirs = dirs
+        self.files = files
+        self.links = links if links is not None else {}
+        self.real_dirs = real_dirs if real_dirs is not None else {}
+
+    @classmethod
+    def scan(cls, path=None, root=None):
+        # type: (str, str) -> Inventory
+        """Lists every directory of `path' once.
+
+        :param path: a PATH like string, the environment's PATH by default
+        :param root: look for the directories of `path' inside `root' (an unpacked image or a chroot) rather than in
+                     '/', the paths are relative to `root' (/usr/bin/python and not ROOT/usr/bin/python), and so are
+                     the links (an absolute link points to somewhere inside `root')
+        """
+        if path is None:
+            path = os.environ.get("PATH", os.defpath)
+        if root is not None:
+            root = os.path.abspath(root).rstrip('/')
+
+        def realpath(p):
+            stats.count("realpath_calls")
+            return os.path.realpath(p) if root is None else _realpath_in(root, p)
+
+        def on_host(p):
+            return p if root is None else root + p
+
+        dirs = path.split(":")
+        files = {}
+        links = {}
+        real_dirs = {}
+        for d in dirs:
+            if d in files:
+                continue
+            files[d] = names = []
+            if root is not None and not d.startswith('/'):
+                # relative to what?
+                continue
+            real_d = realpath(d or os.curdir)
+            if real_d != d:
+                real_dirs[d] = real_d
+            try:
+                listing = list(os.scandir(on_host(real_d)))
+            except OSError:
+                continue
+            stats.count("dirs_scanned")
+            for entry in listing:
+                full = os.path.join(d, entry.name)
+                stats.count("lstat_calls")
+                if entry.is_symlink():
+                    real = realpath(os.path.join(real_d, entry.name))
+                    target = on_host(real)
+                    if os.path.isdir(target) or not os.access(target, os.X_OK):
+                        continue
+                    links[full] = real
+                elif entry.is_dir() or not os.access(entry.path, os.X_OK):
+                    continue
+                names.append(entry.name)
+        return cls(dirs, files, links, real_dirs)
+
+    def which(self, pattern):
+        # type: (str) -> List[str]
+        """The same as `putshebang.which', but over the inventory."""
+        found = []
+        for d in self.dirs:
+            names = self.files.get(d, ())
+            stats.count("executables_considered", len(names))
+            # globs don't match hidden files unless asked to
+            found.extend(os.path.join(d, name) for name in fnmatch.filter(names, pattern)
+                         if not name.startswith('.') or pattern.startswith('.'))
+        return found
+
+    def link_info(self, path):
+        # type: (str) -> Tuple[bool, str]
+        """:return: whether `path' is a link, and its real path"""
+        try:
+            return True, self.links[path]
+        except KeyError:
+            pass
+        d, name = os.path.split(path)
+        if d in self.real_dirs:
+            return False, os.path.join(self.real_dirs[d], name)
+        return False, path
+
+    def activate(self):
+        # type: () -> Inventory
+        """Makes every lookup answered by this inventory."""
+        Inventory.current = self
+        return self
+
+    @staticmethod
+    def deactivate():
+        # type: () -> None
+        """Goes back to looking at the file system."""
+        Inventory.current = None
+
+    def dump(self, f):
+        # type: (IO[str]) -> None
+        json.dump({"format": Inventory.FORMAT, "dirs": self.dirs, "files": self.files, "links": self.links,
+                   "real_dirs": self.real_dirs}, f, separators=(',', ':'))
+
+    @classmethod
+    def load(cls, f):
+        # type: (IO[str]) -> Inventory
+        data = json.load(f)
+        if data.get("format") != Inventory.FORMAT:
+            raise ValueError("unsupported inventory format %r" % data.get("format"))
+        return cls(data["dirs"], data["files"], data["links"], data.get("real_dirs"))
+
+
+class _Job(object):
+    """something done by a worker of `PathLister' (the listing of a directory, mostly)"""
+
+    def __init__(self, func, failed=None):
+        # type: (Callable, object) -> None
+        """Constructor.
+
+        :param func: what's to be done, its return value is the result
+        :param failed: the result if it raises an OSError
+        """
+        self.func = func
+        self.failed = failed
+        self.done = threading.Event()
+        self.result = None
+
+
+class PathLister(object):
+    """Lists the PATH directories in a few threads, and gives up on the ones that don't answer in time.
+
+    A directory on a stalled network mount can block whatever touches it for minutes, so it's only ever touched by a
+    worker thread. If it doesn't answer within `timeout' seconds, it's reported (in `slow') and skipped, and it's
+    skipped without waiting from then on, until the worker gets an answer.
+
+    The listings are remembered along with the mtimes of their directories, a directory is listed again only when
+    its mtime changes (a stat, rather than a listing, per lookup, and it's done by a worker too, under the same
+    timeout). A chmod doesn't change the mtime of the directory though, so the files that weren't executable are
+    checked again every time, and the ones that were are checked once they're looked for (see `which').
+
+    basic usage:
+        >>> PathLister.current = PathLister(timeout=0.5)
+        >>> PathLister.current.listings(["/usr/bin", "/net/tools/bin"])
+        [('/usr/bin', ['python3', ...])]
+        >>> PathLister.current.slow
+        {'/net/tools/bin'}
+    """
+
+    # the lister of `which'
+    current = None  # type: PathLister
+
+    def __init__(self, timeout=2.0, workers=8):
+        # type: (float, int) -> None
+        """Constructor.
+
+        :param timeout: the seconds to wait for a directory that isn't known yet (or that has changed)
+        :param workers: the maximum number of threads
+        """
+        self.timeout = timeout
+        self.workers = workers
+        # {directory: (its mtime, [names of the executables in it], [names of the other files in it])}
+        self.cache = {}  # type: Dict[str, Tuple[int, List[str], List[str]]]
+        # the directories that didn't answer in time
+        self.slow = set()
+        self._pending = {}  # type: Dict[object, _Job]
+        self._queue = deque()
+        self._idle = 0
+        self._threads = 0
+        self._lock = threading.Condition()
+
+    def _worker(self):
+        while True:
+            with self._lock:
+                self._idle += 1
+                while not self._queue:
+                    self._lock.wait()
+                self._idle -= 1
+                job = self._queue.popleft()
+            try:
+                job.result = job.func()
+            except OSError:
+                job.result = job.failed
+            job.done.set()
+
+    def _submit(self, key, func, failed=None):
+        # type: (object, Callable, object) -> _Job
+        """:return: the job of `key', `func' is queued for it unless it's already there"""
+        with self._lock:
+            job = self._pending.get(key)
+            if job is None:
+                job = self._pending[key] = _Job(func, failed)
+                self._queue.append(job)
+                if self._idle < len(self._queue) and self._threads < self.workers:
+                    # the threads are daemons, a thread stuck forever must not keep the process alive
+                    thread = threading.Thread(target=self._worker, name="putshebang-lister")
+                    thread.daemon = True
+                    thread.start()
+                    self._threads += 1
+                self._lock.notify()
+            return job
+
+    def _forget(self, key, job):
+        # type: (object, _Job) -> None
+        with self._lock:
+            if self._pending.get(key) is job:
+                del self._pending[key]
+
+    def _list(self, d):
+        # type: (str) -> _Job
+        known = self.cache.get(d)
+        return self._submit(d, lambda: _refresh(d, known), (None, [], []))
+
+    def _collect(self, d, job):
+        # type: (str, _Job) -> List[str]
+        self._forget(d, job)
+        self.slow.discard(d)
+        self.cache[d] = job.result
+        return job.result[1]
+
+    def listings(self, dirs):
+        # type: (List[str]) -> List[Tuple[str, List[str]]]
+        """:return: [(directory, [names of the executables in it])] for the `dirs' that answered, in order"""
+        jobs = {}
+        found = {}
+        for d in dirs:
+            if d in found or d in jobs:
+                continue
+            if d in self.slow:
+                job = self._list(d)
+                if job.done.is_set():
+                    found[d] = self._collect(d, job)
+                continue
+            jobs[d] = self._list(d)
+
+        deadline = _clock() + self.timeout
+        for d, job in jobs.items():
+            if job.done.wait(max(0., deadline - _clock())):
+                found[d] = self._collect(d, job)
+            else:
+                stats.count("dirs_timed_out")
+                self.slow.add(d)
+        return [(d, found[d]) for d in dirs if d in found]
+
+    def lookup(self, dirs, name):
+        # type: (List[str], str) -> str or None
+        """:return: the first of `dirs' that has an executable named `name', None if none of them has
+
+        Nothing is listed, that's a stat per directory (by a worker, under the same timeout), as far as the first
+        directory that has it.
+        """
+        for d in dirs:
+            if d in self.slow:
+                continue
+            path = os.path.join(d or os.curdir, name)
+            key = ("lookup", path)
+            job = self._submit(key, lambda path=path: _is_executable(path), False)
+            if not job.done.wait(self.timeout):
+                stats.count("dirs_timed_out")
+                self.slow.add(d)
+                continue
+            self._forget(key, job)
+            if job.result:
+                return d
+        return None
+
+    def executable(self, d, name):
+        # type: (str, str) -> bool
+        """:return: whether `name', that's listed as an executable of `d', still is one (it's moved to the other files
+                    of `d' if it isn't, a chmod doesn't change the mtime of `d')"""
+        stats.count("lstat_calls")
+        if os.access(os.path.join(d or os.curdir, name), os.X_OK):
+            return True
+        mtime, names, others = self.cache[d]
+        self.cache[d] = mtime, [n for n in names if n != name], others + [name]
+        return False
+
+    def fingerprint(self, dirs):
+        # type: (List[str]) -> Tuple
+        """:return: the mtimes of `dirs' and the number of executables in them (as `listings' finds them, so the slow
+                    ones are "slow")"""
+        self.listings(dirs)
+        fingerprint = []
+        for d in dirs:
+            if d in self.slow:
+                fingerprint.append("slow")
+                continue
+            mtime, names, others = self.cache.get(d, (None, [], []))
+            fingerprint.append((mtime, len(names)))
+        return tuple(fingerprint)
+
+
+def _is_executable(path):
+    # type: (str) -> bool
+    stats.count("lstat_calls")
+    return os.path.isfile(path) and os.access(path, os.X_OK)
+
+
+def _refresh(d, known):
+    # type: (str, Tuple[int, List[str], List[str]]) -> Tuple[int, List[str], List[str]]
+    """:return: `known' if the directory `d' hasn't changed since it was listed, its new listing otherwise
+
+    The files that weren't executable are checked again either way, a chmod doesn't change the mtime of `d'.
+    """
+    if known is None or os.stat(d or os.curdir).st_mtime_ns != known[0]:
+        return _list_executables(d)
+
+    mtime, names, others = known
+    became = []
+    for name in others:
+        stats.count("lstat_calls")
+        if os.access(os.path.join(d or os.curdir, name), os.X_OK):
+            became.append(name)
+    if not became:
+        return known
+    return mtime, names + became, [name for name in others if name not in became]
+
+
+def _list_executables(d):
+    # type: (str) -> Tuple[int, List[str], List[str]]
+    """:return: the mtime of the directory `d', the names of the executables in it and the names of the other files"""
+    mtime = os.stat(d or os.curdir).st_mtime_ns
+    names = []
+    others = []
+    for entry in os.scandir(d or os.curdir):
+        stats.count("lstat_calls")
+        try:
+            if entry.is_dir():
+                continue
+            (names if os.access(entry.path, os.X_OK) else others).append(entry.name)
+        except OSError:
+            continue
+    stats.count("dirs_scanned")
+    return mtime, names, others
+
+
+PathLister.current = PathLister()
+
+
+def _realpath_in(root, path, max_links=40):
+    # type: (str, str, int) -> str
+    """Like os.path.realpath, but as if `root' was '/'.
+
+    :param root: an absolute path, without the trailing '/'
+    :param path: an absolute path inside `root'
+    :param max_links: give up after following that many links (they're probably looping)
+    :return: the real path of `path', relative to `root'
+    """
+    parts = path.split('/')
+    resolved = '/'
+    while parts:
+        part = parts.pop(0)
+        if part in ('', '.'):
+            continue
+        if part == '..':
+            resolved = os.path.dirname(resolved)
+            continue
+
+        candidate = os.path.join(resolved, part)
+        if max_links and os.path.islink(root + candidate):
+            max_links -= 1
+            target = os.readlink(root + candidate)
+            if target.startswith('/'):
+                resolved = '/'
+            parts = target.split('/') + parts
+        else:
+            resolved = candidate
+    return resolved
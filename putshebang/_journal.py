@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+
+"""the journal of the edits, for undoing them"""
+import json
+import os
+import threading
+
+from typing import Dict, Iterator, Tuple
+
+
+def split_edit(old, new):
+    # type: (bytes, bytes) -> Tuple[bytes, bytes]
+    """Finds what has been changed at the beginning of `old' to make it `new'.
+
+    :return: (removed, added) where old == removed + rest and new == added + rest, for the longest possible rest
+    """
+    o, n = memoryview(old), memoryview(new)
+    limit = min(len(old), len(new))
+    common = 0
+    size = 64 * 1024
+    # compare big chunks from the end, then halve the chunk once they differ
+    while size and common < limit:
+        size = min(size, limit - common)
+        if o[len(old) - common - size:len(old) - common] == n[len(new) - common - size:len(new) - common]:
+            common += size
+        else:
+            size //= 2
+    return old[:len(old) - common], new[:len(new) - common]
+
+
+def _encode(data):
+    # type: (bytes) -> str
+    # latin-1 maps every byte to a character, so nothing is lost and ASCII stays readable
+    return data.decode('latin-1')
+
+
+def _decode(text):
+    # type: (str) -> bytes
+    return text.encode('latin-1')
+
+
+class Journal(object):
+    """An append only file of the edits done to files, one json object per line.
+
+    Only the bytes that changed at the beginning of a file are kept (the shebang and what's around it), not the file.
+
+    basic usage:
+        >>> journal = Journal("run.journal")
+        >>> journal.record("file.py", b"print(1)\\n", b"#!/usr/bin/python\\n\\nprint(1)\\n")
+        >>> journal.close()
+        >>> for record in Journal.undo("run.journal"):
+        ...     print(record["status"])
+        restored
+    """
+
+    def __init__(self, name):
+        # type: (str) -> None
+        self.name = name
+        self._file = open(name, 'a')
+        self._lock = threading.Lock()
+
+    def record(self, file_name, old, new, mode=None, created=False):
+        # type: (str, bytes, bytes, Tuple[int, int], bool) -> None
+        """Records an edit.
+
+        :param file_name: the file that has been edited
+        :param old: the contents before the edit
+        :param new: the contents after the edit
+        :param mode: (old mode, new mode) if the mode has been changed
+        :param created: whether the file didn't exist before
+        """
+        removed, added = split_edit(old, new)
+        entry = {"file": os.path.abspath(file_name), "removed": _encode(removed), "added": _encode(added),
+                 "mode": list(mode) if mode else None, "created": created}
+        line = json.dumps(entry, separators=(',', ':')) + "\n"
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+
+    def close(self):
+        # type: () -> None
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @staticmethod
+    def undo(name):
+        # type: (str) -> Iterator[Dict]
+        """Reverts every edit recorded in the journal `name', the latest first.
+
+        :return: a record for every edit, its 'status' is either 'restored' or 'failed' (with a 'message')
+        """
+        with open(name) as f:
+            entries = [json.loads(line) for line in f if line.strip()]
+
+        for entry in reversed(entries):
+            file_name = entry["file"]
+            record = {"file": file_name, "status": "restored", "shebang": None, "message": None}
+            added, removed = _decode(entry["added"]), _decode(entry["removed"])
+            try:
+                with open(file_name, 'rb') as f:
+                    data = f.read()
+                if not data.startswith(added):
+                    raise ValueError("the file has been changed since the edit")
+
+                if entry["created"] and data == added:
+                    os.remove(file_name)
+                else:
+                    if removed != added:
+                        with open(file_name, 'wb') as f:
+                            f.write(removed + data[len(added):])
+                    if entry["mode"]:
+                        old_mode, new_mode = entry["mode"]
+                        if os.stat(file_name).st_mode == new_mode:
+                            os.chmod(file_name, old_mode)
+            except (OSError, IOError, ValueError) as e:
+                record.update(status="failed", message=str(e))
+            yield record
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+
+"""the interpreters chosen for the files, so that they're chosen only once"""
+import fnmatch
+import json
+import os
+import threading
+
+from typing import Dict, List, Tuple
+
+from putshebang.shebangs import ENV
+
+
+def interpreter_of(shebang):
+    # type: (str) -> str
+    """:return: the name of the interpreter of `shebang' ('#!/usr/bin/python3 -u' and '#!/usr/bin/env python3' are
+                both 'python3')"""
+    words = shebang[2:].split()
+    if words and words[0] == ENV:
+        words = [w for w in words[1:] if not w.startswith('-')]
+    return os.path.basename(words[0]) if words else ''
+
+
+class Lockfile(object):
+    """The shebangs chosen per file (or per glob), one json object per line, the later lines override the earlier.
+
+    The paths are relative to the directory of the lock file, so it can be committed along with the files:
+        {"file": "bin/tool.py", "interpreter": "python3", "shebang": "#!/usr/bin/python3"}
+        {"glob": "scripts/*.sh", "interpreter": "bash", "shebang": "#!/bin/bash"}
+
+    The files are looked up first, then the globs (the last one that matches). New choices are appended, the file is
+    rewritten only when most of its lines have been overridden.
+
+    basic usage:
+        >>> lock = Lockfile(".putshebang.lock")
+        >>> lock.lookup("bin/tool.py")
+        {'file': 'bin/tool.py', 'interpreter': 'python3', 'shebang': '#!/usr/bin/python3'}
+        >>> lock.record("bin/other.py", "#!/usr/bin/python3")
+        >>> lock.close()
+    """
+
+    NAME = ".putshebang.lock"
+
+    def __init__(self, name):
+        # type: (str) -> None
+        """Loads the lock file `name', it's created once something is recorded if it doesn't exist.
+
+        :raise ValueError: if a line isn't a lock entry
+        """
+        self.name = name
+        self.base = os.path.dirname(os.path.abspath(name))
+        self.files = {}  # type: Dict[str, Dict]
+        self.globs = []  # type: List[Tuple[str, Dict]]
+        self.lines = 0
+        self._file = None
+        self._lock = threading.Lock()
+
+        try:
+            f = open(name)
+        except (OSError, IOError):
+            return
+        with f:
+            for n, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                self.lines += 1
+                try:
+                    entry = json.loads(line)
+                    if not isinstance(entry.get("shebang"), str):
+                        raise KeyError("shebang")
+                    if "file" in entry:
+                        self.files[entry["file"]] = entry
+                    else:
+                        self.globs.append((entry["glob"], entry))
+                except (ValueError, KeyError, AttributeError):
+                    raise ValueError("{}:{}: not a lock entry".format(name, n))
+
+    def relative(self, path):
+        # type: (str) -> str
+        """:return: `path' as it's in the lock file"""
+        return os.path.relpath(os.path.abspath(path), self.base).replace(os.sep, '/')
+
+    def lookup(self, path):
+        # type: (str) -> Dict or None
+        """:return: the entry of the file `path', None if nothing has been chosen for it"""
+        relative = self.relative(path)
+        entry = self.files.get(relative)
+        if entry is None:
+            for pattern, e in reversed(self.globs):
+                if fnmatch.fnmatchcase(relative, pattern):
+                    return e
+        return entry
+
+    def record(self, path, shebang):
+        # type: (str, str) -> None
+        """Records that `shebang' (without the newline) has been chosen for the file `path'."""
+        entry = {"file": self.relative(path), "interpreter": interpreter_of(shebang), "shebang": shebang}
+        with self._lock:
+            if self.files.get(entry["file"]) == entry:
+                return
+            self.files[entry["file"]] = entry
+            if self._file is None:
+                self._file = open(self.name, 'a')
+            self._file.write(json.dumps(entry, separators=(',', ':'), sort_keys=True) + "\n")
+            self.lines += 1
+
+    def close(self):
+        # type: () -> None
+        """Closes the file, rewriting it without the overridden lines if they're the most of it."""
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.close()
+            self._file = None
+            if self.lines > 2 * (len(self.files) + len(self.globs)):
+                self._compact()
+
+    def _compact(self):
+        # type: () -> None
+        tmp = "%s.%d" % (self.name, os.getpid())
+        with open(tmp, 'w') as f:
+            for entry in [e for p, e in self.globs] + [self.files[p] for p in sorted(self.files)]:
+                f.write(json.dumps(entry, separators=(',', ':'), sort_keys=True) + "\n")
+        os.rename(tmp, self.name)
+        self.lines = len(self.files) + len(self.globs)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
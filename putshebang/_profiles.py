@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+
+"""the flags that are put after the interpreter, per language"""
+import os
+import re
+
+from typing import Dict
+
+from putshebang._lockfile import interpreter_of
+from putshebang.shebangs import ENV, _split_flags
+
+# {profile: {interpreter name (without the version): its flags}}
+PROFILES = {
+    # what a short lived script doesn't need at startup, but nothing that changes what it can import:
+    #   python -E -> ignore the PYTHON* environment variables, -s -> no user site directory
+    #   bash --noprofile --norc, zsh -f -> no startup files
+    "startup": {
+        "python": "-Es",
+        "pypy": "-Es",
+        "bash": "--noprofile --norc",
+        "zsh": "-f",
+    },
+}  # type: Dict[str, Dict[str, str]]
+
+
+def flags_of(profile, interpreter):
+    # type: (str, str) -> str
+    """:return: the flags of `profile' for `interpreter' (a name or a path, 'python3.6' is 'python'), '' if none"""
+    name = re.match(r"[^\d.-]*", os.path.basename(interpreter)).group()
+    return PROFILES[profile].get(name, '')
+
+
+def apply_profile(shebang, profile):
+    # type: (str, str) -> str
+    """Adds the flags of `profile' to `shebang' (without the newline), the ones that are already there are skipped.
+
+    The kernel passes whatever follows the interpreter as a single argument, so the shebang becomes an 'env -S' one
+    when that's more than one word:
+        >>> apply_profile("#!/usr/bin/python3", "startup")
+        '#!/usr/bin/python3 -Es'
+        >>> apply_profile("#!/bin/bash", "startup")
+        '#!/usr/bin/env -S /bin/bash --noprofile --norc'
+    """
+    words = shebang[2:].split()
+    present = _split_flags(words)
+    flags = [f for f in flags_of(profile, interpreter_of(shebang)).split() if not _split_flags([f]) <= present]
+    if not flags:
+        return shebang
+
+    if words[0] == ENV:
+        if words[1] != "-S":
+            words.insert(1, "-S")
+        return "#!" + " ".join(words + flags)
+    if len(words) + len(flags) > 2:
+        return "#!{} -S {}".format(ENV, " ".join(words + flags))
+    return "#!" + " ".join(words + flags)
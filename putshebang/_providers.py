@@ -0,0 +1,275 @@
+# -*- coding: utf-8 -*-
+
+"""interpreters installed by version managers, and not on PATH"""
+import fnmatch
+import glob
+import json
+import os
+import threading
+
+from typing import Dict, IO, List, Tuple
+
+from putshebang._stats import stats
+
+# {name: provider class}, see `register'
+PROVIDERS = {}  # type: Dict[str, type]
+
+
+def register(cls):
+    # type: (type) -> type
+    """Makes the provider `cls' known by its name, it can be used as a class decorator."""
+    PROVIDERS[cls.name] = cls
+    return cls
+
+
+class Provider(object):
+    """Knows where a version manager puts the interpreters it installs.
+
+    A provider only lists directories, the index does the rest:
+        roots    -> the directories that change whenever something is installed or removed (`versions' for pyenv),
+                    only they are looked at before every lookup
+        bin_dirs -> the directories of the executables
+    """
+
+    name = None  # type: str
+
+    def __init__(self, home=None):
+        # type: (str) -> None
+        self.home = home if home is not None else os.path.expanduser("~")
+
+    def roots(self):
+        # type: () -> List[str]
+        return []
+
+    def bin_dirs(self):
+        # type: () -> List[str]
+        return []
+
+
+@register
+class Pyenv(Provider):
+    name = "pyenv"
+
+    def _root(self):
+        return os.environ.get("PYENV_ROOT") or os.path.join(self.home, ".pyenv")
+
+    def roots(self):
+        return [os.path.join(self._root(), "versions")]
+
+    def bin_dirs(self):
+        return sorted(glob.glob(os.path.join(self._root(), "versions", "*", "bin")))
+
+
+@register
+class Asdf(Provider):
+    name = "asdf"
+
+    def _installs(self):
+        return os.path.join(os.environ.get("ASDF_DATA_DIR") or os.path.join(self.home, ".asdf"), "installs")
+
+    def roots(self):
+        # a new version is a new directory inside the directory of its plugin
+        return [self._installs()] + sorted(glob.glob(os.path.join(self._installs(), "*")))
+
+    def bin_dirs(self):
+        return sorted(glob.glob(os.path.join(self._installs(), "*", "*", "bin")))
+
+
+@register
+class Conda(Provider):
+    name = "conda"
+
+    BASES = ("miniconda3", "anaconda3", "miniforge3", "mambaforge", "miniconda2", "anaconda2")
+
+    def _bases(self):
+        bases = [os.path.join(self.home, base) for base in Conda.BASES]
+        if os.environ.get("CONDA_EXE"):
+            # <base>/bin/conda
+            bases.insert(0, os.path.dirname(os.path.dirname(os.environ["CONDA_EXE"])))
+        return [base for base in bases if os.path.isdir(base)]
+
+    def roots(self):
+        return [os.path.join(base, "envs") for base in self._bases()] + [os.path.join(self.home, ".conda", "envs")]
+
+    def bin_dirs(self):
+        dirs = []
+        for base in self._bases():
+            dirs.append(os.path.join(base, "bin"))
+            dirs.extend(sorted(glob.glob(os.path.join(base, "envs", "*", "bin"))))
+        dirs.extend(sorted(glob.glob(os.path.join(self.home, ".conda", "envs", "*", "bin"))))
+        return dirs
+
+
+@register
+class Nix(Provider):
+    name = "nix"
+
+    def bin_dirs(self):
+        profiles = os.environ.get("NIX_PROFILES", "").split() or [
+            "/run/current-system/sw", "/nix/var/nix/profiles/default", os.path.join(self.home, ".nix-profile")]
+        return [os.path.join(profile, "bin") for profile in profiles]
+
+    def roots(self):
+        # a profile is a link to a store path, and switching it moves the link (the store is never modified)
+        return self.bin_dirs()
+
+
+def _fingerprint(path):
+    # type: (str) -> Tuple[str, int] or None
+    try:
+        return os.path.realpath(path), os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+class ProviderIndex(object):
+    """The executables of the version managers' installs, listed once.
+
+    The index is rebuilt only once a root of a provider changes, and even then only the directories whose mtime
+    changed are listed again. It's kept in a cache file as well, so the next runs start from it.
+
+    basic usage:
+        >>> index = ProviderIndex(["pyenv", "conda"]).activate()
+        >>> which("python3*")  # PATH first, then the installs
+    """
+
+    FORMAT = 1
+
+    # the active index, `which' looks into it after PATH
+    current = None  # type: ProviderIndex
+
+    def __init__(self, providers, cache_file=None):
+        # type: (List[str], str) -> None
+        """Constructor.
+
+        :param providers: the names of the providers, in the order of their precedence
+        :param cache_file: where to keep the index between runs, None for not keeping it
+        """
+        unknown = [name for name in providers if name not in PROVIDERS]
+        if unknown:
+            raise ValueError("unknown providers: %s (known are: %s)" % (", ".join(unknown),
+                                                                        ", ".join(sorted(PROVIDERS))))
+        self.providers = [PROVIDERS[name]() for name in providers]
+        self.cache_file = cache_file
+        self.dirs = []  # type: List[str]
+        # {directory: (its mtime, [names of the executables in it])}
+        self.files = {}  # type: Dict[str, Tuple[int, List[str]]]
+        self._roots = None
+        self._lock = threading.Lock()
+        if cache_file is not None:
+            try:
+                with open(cache_file) as f:
+                    self._load(f)
+            except (OSError, IOError, ValueError, KeyError):
+                pass
+
+    @staticmethod
+    def default_cache_file():
+        # type: () -> str
+        cache = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+        return os.path.join(cache, "putshebang", "providers.json")
+
+    def fingerprint(self):
+        # type: () -> Tuple
+        """The roots of the providers, and what they're at, the index is up to date as long as it's the same."""
+        return tuple(_fingerprint(root) for provider in self.providers for root in provider.roots())
+
+    def refresh(self):
+        # type: () -> bool
+        """Rebuilds the index if a root has changed.
+
+        :return: whether it has been rebuilt
+        """
+        roots = self.fingerprint()
+        with self._lock:
+            if roots == self._roots:
+                return False
+
+            dirs = []
+            files = {}
+            for provider in self.providers:
+                for d in provider.bin_dirs():
+                    if d in files:
+                        continue
+                    try:
+                        mtime = os.stat(d).st_mtime_ns
+                    except OSError:
+                        continue
+                    dirs.append(d)
+                    known = self.files.get(d)
+                    if known is not None and known[0] == mtime:
+                        files[d] = known
+                        continue
+                    files[d] = mtime, _executables(d)
+            changed = files != self.files
+            self.dirs, self.files, self._roots = dirs, files, roots
+
+        if changed and self.cache_file is not None:
+            self._save()
+        return True
+
+    def which(self, pattern):
+        # type: (str) -> List[str]
+        """The same as `putshebang.which', but over the installs."""
+        self.refresh()
+        found = []
+        for d in self.dirs:
+            names = self.files[d][1]
+            stats.count("executables_considered", len(names))
+            found.extend(os.path.join(d, name) for name in fnmatch.filter(names, pattern)
+                         if not name.startswith('.') or pattern.startswith('.'))
+        return found
+
+    def activate(self):
+        # type: () -> ProviderIndex
+        """Makes `which' look into the installs after PATH."""
+        ProviderIndex.current = self
+        return self
+
+    @staticmethod
+    def deactivate():
+        # type: () -> None
+        ProviderIndex.current = None
+
+    def _load(self, f):
+        # type: (IO[str]) -> None
+        data = json.load(f)
+        if data.get("format") != ProviderIndex.FORMAT:
+            return
+        # the roots aren't taken, so the first lookup still checks the directories (a stat each)
+        self.files = {d: (mtime, names) for d, (mtime, names) in data["files"].items()}
+
+    def _save(self):
+        # type: () -> None
+        try:
+            os.makedirs(os.path.dirname(self.cache_file))
+        except OSError:
+            pass
+        tmp = "%s.%d" % (self.cache_file, os.getpid())
+        try:
+            with open(tmp, "w") as f:
+                json.dump({"format": ProviderIndex.FORMAT, "files": self.files}, f, separators=(',', ':'))
+            os.rename(tmp, self.cache_file)
+        except (OSError, IOError):
+            # a cache that can't be written isn't worth failing for
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+
+def _executables(d):
+    # type: (str) -> List[str]
+    """:return: the names of the executables in the directory `d'"""
+    try:
+        listing = list(os.scandir(d))
+    except OSError:
+        return []
+    stats.count("dirs_scanned")
+    names = []
+    for entry in listing:
+        stats.count("lstat_calls")
+        try:
+            if not entry.is_dir() and os.access(entry.path, os.X_OK):
+                names.append(entry.name)
+        except OSError:
+            continue
+    return sorted(names)
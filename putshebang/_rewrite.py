@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+
+"""rewriting shebangs in bulk"""
+import fnmatch
+import json
+import os
+import re
+import stat
+
+from typing import Dict, IO, Tuple
+
+from putshebang._stats import stats
+from putshebang.shebangs import LOCK_TIMEOUT, _check_unchanged, _lock_fd, _read_fd, _write_fd
+
+# the kernel doesn't read more than that of the shebang line, so it's more than enough for matching
+HEADER_SIZE = 512
+# O_NONBLOCK so that a FIFO can't block us, it changes nothing for regular files
+_FLAGS = os.O_NONBLOCK | os.O_NOCTTY | getattr(os, "O_CLOEXEC", 0)
+
+
+class RewriteTable(object):
+    """Replaces old shebangs by new ones, as a table of {old: new} says.
+
+    The old ones are shell like patterns that are matched against the whole shebang line (without the '#!' and the
+    surrounding white spaces), they're all compiled into one regex. The new ones replace the whole line.
+
+    basic usage:
+        >>> table = RewriteTable({"/usr/bin/python2*": "/usr/bin/env python3",
+        ...                       "/usr/local/bin/python": "/usr/bin/python3"})
+        >>> table.match(b"#!/usr/bin/python2.7\\n")
+        '#!/usr/bin/env python3'
+        >>> table.rewrite_file("file.py")
+        (b'#!/usr/bin/python2.7', b'#!/usr/bin/env python3')
+    """
+
+    def __init__(self, mapping):
+        # type: (Dict[str, str]) -> None
+        """Constructor.
+
+        :param mapping: {old pattern: new shebang}, both without the '#!'
+        """
+        self.mapping = mapping
+        self.replacements = {}
+        groups = []
+        for n, (pattern, replacement) in enumerate(mapping.items()):
+            name = "r%d" % n
+            self.replacements[name] = "#!" + replacement.strip()
+            groups.append("(?P<%s>%s)" % (name, fnmatch.translate(pattern.strip())))
+        self.regex = re.compile(r"#![ \t]*(?:%s)" % "|".join(groups)) if groups else None
+
+    @classmethod
+    def load(cls, f):
+        # type: (IO[str]) -> RewriteTable
+        """Loads a json object of {old pattern: new shebang}."""
+        mapping = json.load(f)
+        if not isinstance(mapping, dict):
+            raise ValueError("the rewrite table must be a json object of {old pattern: new shebang}")
+        return cls(mapping)
+
+    def match(self, header):
+        # type: (bytes) -> str or None
+        """:return: the new shebang for the shebang line at the beginning of `header', None if it's not in the table"""
+        if self.regex is None or not header.startswith(b"#!"):
+            return None
+        eol = header.find(b'\n')
+        if eol == -1:
+            eol = len(header)
+        # only the shebang line is decoded, and latin-1 never fails
+        line = header[:eol].rstrip(b" \t\r").decode('latin-1')
+        m = self.regex.match(line)
+        if m is None:
+            return None
+        stats.count("regex_matches")
+        return self.replacements[m.lastgroup]
+
+    def rewrite_file(self, name, preserve_mtime=False, lock=False, lock_timeout=LOCK_TIMEOUT):
+        # type: (str, bool, bool, float) -> Tuple[bytes, bytes] or None
+        """Rewrites the shebang of the file `name' if it's in the table, only its header is read otherwise.
+
+        The file is opened for writing (and locked) only once its shebang matches, so the ones that don't match can
+        be read-only, busy or locked by someone else.
+
+        :param preserve_mtime: restore the original access and modification times after rewriting the file
+        :param lock: take an exclusive advisory lock of the file while it's being rewritten
+        :param lock_timeout: the seconds to wait for the lock
+        :return: (old shebang line, new shebang line) or None if the file hasn't been touched
+        :raise ValueError: if `name' isn't a regular file
+        :raise ConcurrentModificationError: the file has been changed while it was being read, or it's been locked by
+                                            someone else for `lock_timeout' seconds
+        """
+        fd, st = _open_regular(name)
+        try:
+            header = _read_fd(fd, HEADER_SIZE)
+            stats.count("bytes_read", len(header))
+            new = self.match(header)
+            if new is None:
+                stats.count("files_skipped")
+                return None
+
+            new = os.fsencode(new)
+            old = header[:header.find(b'\n')] if b'\n' in header else header
+            if old.rstrip(b" \t\r") == new:
+                stats.count("files_skipped")
+                return None
+
+            wfd = os.open(name, os.O_RDWR | _FLAGS)
+            try:
+                if lock:
+                    _lock_fd(wfd, lock_timeout)
+                rest = header[len(old):] + _read_fd(fd, st.st_size - len(header))
+                stats.count("bytes_read", len(rest) - len(header) + len(old))
+
+                with stats.phase("write", file=name):
+                    # it's the same file that has been read, and nobody has written it in the meantime
+                    _check_unchanged(wfd, name, st)
+                    _write_fd(wfd, new + rest)
+                    if preserve_mtime:
+                        os.utime(wfd, ns=(st.st_atime_ns, st.st_mtime_ns))
+            finally:
+                os.close(wfd)
+        finally:
+            os.close(fd)
+        stats.count("bytes_written", len(new) + len(rest))
+        stats.count("files_rewritten")
+        return old, new
+
+
+def _open_regular(name):
+    # type: (str) -> Tuple[int, os.stat_result]
+    """:return: a read-only descriptor of the file `name' and its stat
+    :raise ValueError: if `name' isn't a regular file"""
+    fd = os.open(name, os.O_RDONLY | _FLAGS)
+    try:
+        st = os.fstat(fd)
+        if not stat.S_ISREG(st.st_mode):
+            raise ValueError("file name {!r} is not valid".format(name))
+    except BaseException:
+        os.close(fd)
+        raise
+    return fd, st
+
+
+def read_header(name):
+    # type: (str) -> Tuple[bytes, os.stat_result]
+    """:return: the first `HEADER_SIZE' bytes of the file `name' (that's where its shebang is), and its stat
+    :raise ValueError: if `name' isn't a regular file"""
+    fd, st = _open_regular(name)
+    try:
+        header = _read_fd(fd, HEADER_SIZE)
+    finally:
+        os.close(fd)
+    stats.count("bytes_read", len(header))
+    return header, st
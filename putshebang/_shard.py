@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+
+"""splitting a run across many machines, and putting the reports back together"""
+import json
+import os
+import zlib
+
+from typing import Dict, IO, Iterable, Tuple
+
+# the statuses that make a run fail
+PROBLEMS = ("failed", "conflict", "wrong", "missing")
+
+
+def parse_shard(text):
+    # type: (str) -> Tuple[int, int]
+    """Parses 'i/N' (i counts from 1).
+
+    :return: (i, N)
+    """
+    index, sep, count = text.partition('/')
+    try:
+        index, count = int(index), int(count)
+    except ValueError:
+        index = count = 0
+    if not sep or not 1 <= index <= count:
+        raise ValueError("a shard must look like i/N where 1 <= i <= N, not {!r}".format(text))
+    return index, count
+
+
+def shard_of(path, count):
+    # type: (str, int) -> int
+    """:return: the shard (counting from 1) of `path' out of `count' shards
+
+    It's a hash of the path relative to the current directory, so it's the same on every machine (wherever the
+    checkout is) and doesn't depend on the order of the files.
+    """
+    relative = os.path.normpath(os.path.relpath(path) if os.path.isabs(path) else path)
+    return zlib.crc32(os.fsencode(relative)) % count + 1
+
+
+def merge_reports(reports):
+    # type: (Iterable[IO[str]]) -> Dict
+    """Merges the jsonl reports (of '--format jsonl') of the shards of a run.
+
+    :return: {'files': the number of files, 'status': {status: number of files},
+              'problems': the records whose status is one of PROBLEMS, sorted by file}
+    """
+    status = {}
+    problems = []
+    files = 0
+    for report in reports:
+        for line in report:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            files += 1
+            status[record["status"]] = status.get(record["status"], 0) + 1
+            if record["status"] in PROBLEMS:
+                problems.append(record)
+    problems.sort(key=lambda r: r["file"])
+    return {"files": files, "status": status, "problems": problems}
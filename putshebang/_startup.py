@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+
+"""how long the interpreters take to start, to pick the fastest one"""
+import json
+import os
+import subprocess
+import threading
+import time
+
+from typing import Dict, IO, List, Tuple
+
+from putshebang._stats import stats
+
+
+class StartupTimer(object):
+    """Times how long an interpreter takes to run an empty program, the best out of a few runs.
+
+    The program is an empty stdin, every interpreter we know runs what it reads from stdin when it's given nothing
+    else. The timings are kept per real path of the interpreter along with its mtime, so an interpreter is timed
+    again only once it's upgraded (and a new one only once), they're kept in a cache file between runs as well.
+
+    basic usage:
+        >>> timer = StartupTimer(cache_file=StartupTimer.default_cache_file()).activate()
+        >>> timer.fastest(["/usr/bin/python3.6", "/usr/bin/pypy3"])
+        '/usr/bin/python3.6'
+    """
+
+    FORMAT = 1
+
+    # the active timer, `--prefer fastest-startup' picks the interpreters by it
+    current = None  # type: StartupTimer
+
+    def __init__(self, cache_file=None, repeat=3, timeout=2.0):
+        # type: (str, int, float) -> None
+        """Constructor.
+
+        :param cache_file: where to keep the timings between runs, None for not keeping them
+        :param repeat: how many times an interpreter is run, the best time is taken
+        :param timeout: the time (in seconds) that a single run may take, an interpreter that takes longer (or fails)
+                        is never the fastest
+        """
+        self.cache_file = cache_file
+        self.repeat = repeat
+        self.timeout = timeout
+        # {real path: (mtime, seconds or None)}
+        self.timings = {}  # type: Dict[str, Tuple[int, float]]
+        self._lock = threading.Lock()
+        if cache_file is not None:
+            try:
+                with open(cache_file) as f:
+                    self._load(f)
+            except (OSError, IOError, ValueError, KeyError):
+                pass
+
+    @staticmethod
+    def default_cache_file():
+        # type: () -> str
+        cache = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+        return os.path.join(cache, "putshebang", "startup.json")
+
+    def time(self, path):
+        # type: (str) -> float or None
+        """:return: the startup time of the interpreter `path' in seconds, None if it can't be run (in time)"""
+        real = os.path.realpath(path)
+        try:
+            mtime = os.stat(real).st_mtime_ns
+        except OSError:
+            return None
+        # one at a time, interpreters that are started together slow each other down
+        with self._lock:
+            known = self.timings.get(real)
+            if known is not None and known[0] == mtime:
+                return known[1]
+            seconds = self._measure(real)
+            self.timings[real] = mtime, seconds
+            if self.cache_file is not None:
+                self._save()
+        return seconds
+
+    def _measure(self, path):
+        # type: (str) -> float or None
+        stats.count("interpreters_timed")
+        best = None
+        for _ in range(self.repeat):
+            start = time.perf_counter()
+            try:
+                subprocess.run([path], stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                               stderr=subprocess.DEVNULL, timeout=self.timeout, check=True)
+            except (OSError, subprocess.SubprocessError):
+                return None
+            seconds = time.perf_counter() - start
+            best = seconds if best is None else min(best, seconds)
+        return best
+
+    def fastest(self, paths):
+        # type: (List[str]) -> str or None
+        """:return: the one of `paths' that starts the fastest (the earlier one of a tie), None if none of them runs"""
+        timings = [self.time(path) for path in paths]
+        timed = [(seconds, i) for i, seconds in enumerate(timings) if seconds is not None]
+        return paths[min(timed)[1]] if timed else None
+
+    def activate(self):
+        # type: () -> StartupTimer
+        """Makes the fastest interpreters the default ones."""
+        StartupTimer.current = self
+        return self
+
+    @staticmethod
+    def deactivate():
+        # type: () -> None
+        StartupTimer.current = None
+
+    def _load(self, f):
+        # type: (IO[str]) -> None
+        data = json.load(f)
+        if data.get("format") != StartupTimer.FORMAT:
+            return
+        self.timings = {path: (mtime, seconds) for path, (mtime, seconds) in data["timings"].items()}
+
+    def _save(self):
+        # type: () -> None
+        try:
+            os.makedirs(os.path.dirname(self.cache_file))
+        except OSError:
+            pass
+        tmp = "%s.%d" % (self.cache_file, os.getpid())
+        try:
+            with open(tmp, "w") as f:
+                json.dump({"format": StartupTimer.FORMAT, "timings": self.timings}, f, separators=(',', ':'))
+            os.rename(tmp, self.cache_file)
+        except (OSError, IOError):
+            # a cache that can't be written isn't worth failing for
+            if os.path.exists(tmp):
+                os.remove(tmp)
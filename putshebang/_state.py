@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+
+"""what the last audit found, so the next one looks only at what changed"""
+import hashlib
+import json
+import os
+import struct
+import threading
+
+from typing import Dict, IO, Tuple
+
+# format, len(key), len(shebangs), len(paths), number of entries
+_HEADER = struct.Struct("<4sBIIII")
+# inode, size, mtime_ns, ctime_ns, verdict, index of the shebang
+_ENTRY = struct.Struct("<QQqqBI")
+
+
+class AuditState(object):
+    """The verdicts of `ShebangedFile.check_shebang' per path, and the metadata of the file when it was checked.
+
+    A verdict is reused as long as the inode, the size, the mtime and the ctime of the file are the same (the ctime
+    changes on any write, even one that sets the mtime back), and so is the shebang that it's checked against. The
+    whole state is dropped when its key is different (the key covers the language table and whatever else affects the
+    verdicts).
+
+    The file is binary: a header, the key, the shebangs and the paths (NUL separated) then an array of fixed size
+    entries, so loading it is splitting two blobs and unpacking an array.
+
+    basic usage:
+        >>> state = AuditState.load("audit.state", key)
+        >>> state.get("file.py", os.stat("file.py"), "#!/usr/bin/python3")
+        'correct'
+        >>> state.put("other.py", os.stat("other.py"), "#!/usr/bin/python3", "missing")
+        >>> state.save("audit.state")
+    """
+
+    MAGIC = b"PSAS"
+    FORMAT = 2
+    VERDICTS = ("missing", "correct", "wrong")
+
+    def __init__(self, key):
+        # type: (str) -> None
+        self.key = key
+        # {path: (inode, size, mtime_ns, ctime_ns, verdict, shebang)}, of the last run
+        self.old = {}  # type: Dict[str, Tuple[int, int, int, int, str, str]]
+        # the same, of this run
+        self.new = {}  # type: Dict[str, Tuple[int, int, int, int, str, str]]
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(*parts):
+        # type: (...) -> str
+        """:return: a digest of `parts' (anything json can take)"""
+        data = json.dumps([AuditState.FORMAT] + list(parts), sort_keys=True, separators=(',', ':'))
+        return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+    def get(self, path, st, shebang):
+        # type: (str, os.stat_result, str) -> str or None
+        """:return: the verdict of the last run about `path' (whose stat is `st' now), None if it has to be checked"""
+        entry = self.old.get(path)
+        if entry is None or entry[5] != shebang \
+                or entry[:4] != (st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns):
+            return None
+        with self._lock:
+            self.new[path] = entry
+        return entry[4]
+
+    def put(self, path, st, shebang, verdict):
+        # type: (str, os.stat_result, str, str) -> None
+        """Records the `verdict' about `path', whose stat was `st' when it was read."""
+        with self._lock:
+            self.new[path] = (st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns, verdict, shebang)
+
+    @classmethod
+    def load(cls, name, key):
+        # type: (str, str) -> AuditState
+        """Loads the state file `name', an empty state is returned if it doesn't exist or its key isn't `key'."""
+        state = cls(key)
+        try:
+            with open(name, 'rb') as f:
+                state._read(f)
+        except (OSError, IOError, ValueError, struct.error):
+            state.old = {}
+        return state
+
+    def _read(self, f):
+        # type: (IO[bytes]) -> None
+        data = f.read()
+        magic, fmt, key_len, shebangs_len, paths_len, n = _HEADER.unpack_from(data)
+        if magic != AuditState.MAGIC or fmt != AuditState.FORMAT:
+            return
+        pos = _HEADER.size
+        if data[pos:pos + key_len].decode('ascii') != self.key:
+            return
+        pos += key_len
+        shebangs = [os.fsdecode(s) for s in data[pos:pos + shebangs_len].split(b"\0")]
+        pos += shebangs_len
+        paths = data[pos:pos + paths_len].split(b"\0") if n else []
+        pos += paths_len
+        if len(paths) != n or len(data) - pos != n * _ENTRY.size:
+            raise ValueError("the state file is truncated")
+
+        verdicts = AuditState.VERDICTS
+        self.old = {os.fsdecode(path): (ino, size, mtime, ctime, verdicts[verdict], shebangs[i])
+                    for path, (ino, size, mtime, ctime, verdict, i) in zip(paths, _ENTRY.iter_unpack(data[pos:]))}
+
+    def save(self, name):
+        # type: (str) -> None
+        """Writes the verdicts of this run (only them) into `name', atomically."""
+        shebangs = {}
+        paths = []
+        entries = []
+        for path, (ino, size, mtime, ctime, verdict, shebang) in self.new.items():
+            paths.append(os.fsencode(path))
+            entries.append(_ENTRY.pack(ino, size, mtime, ctime, AuditState.VERDICTS.index(verdict),
+                                       shebangs.setdefault(shebang, len(shebangs))))
+        key = self.key.encode('ascii')
+        shebangs_blob = b"\0".join(os.fsencode(s) for s in sorted(shebangs, key=shebangs.get))
+        paths_blob = b"\0".join(paths)
+
+        tmp = "%s.%d" % (name, os.getpid())
+        with open(tmp, 'wb') as f:
+            f.write(_HEADER.pack(AuditState.MAGIC, AuditState.FORMAT, len(key), len(shebangs_blob), len(paths_blob),
+                                 len(entries)))
+            f.write(key)
+            f.write(shebangs_blob)
+            f.write(paths_blob)
+            f.write(b"".join(entries))
+        os.rename(tmp, name)
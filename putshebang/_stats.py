@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+"""counters and timings of what putshebang does"""
+import functools
+import threading
+import time
+from contextlib import contextmanager
+
+from typing import Callable, Dict, List
+
+_clock = getattr(time, "perf_counter", time.time)
+
+
+class Stats(object):
+    """Counts what happens per phase of a run, and calls the hooks after every phase.
+
+    The phases are:
+        discovery  -> looking for executables on PATH (`which')
+        resolution -> building the interpreters of an extension (`ShebangedFile.get_extension'),
+                      it includes the discovery it does
+        read       -> reading a file
+        write      -> writing a file and changing its mode
+
+    basic usage:
+        >>> from putshebang import stats
+        >>> stats.add_hook(lambda phase, seconds, info: print(phase, info))
+        >>> stats.counters["dirs_scanned"]
+        0
+    """
+
+    COUNTERS = ("dirs_scanned", "executables_considered", "regex_matches", "lstat_calls", "realpath_calls",
+                "bytes_read", "bytes_written", "files_skipped", "files_rewritten", "files_failed",
+                "cache_hits", "cache_misses", "venv_dirs_checked", "dirs_timed_out")
+
+    def __init__(self):
+        self.hooks = []
+        self._lock = threading.Lock()
+        self.counters = {}  # type: Dict[str, int]
+        self.timings = {}  # type: Dict[str, List[float, int]]
+        self.reset()
+
+    def reset(self):
+        # type: () -> None
+        """Zeroes everything, the hooks are kept."""
+        self.counters = dict.fromkeys(Stats.COUNTERS, 0)
+        self.timings = {}
+
+    def count(self, name, n=1):
+        # type: (str, int) -> None
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def add_hook(self, hook):
+        # type: (Callable[[str, float, Dict], None]) -> None
+        """Calls `hook(phase, seconds, info)' whenever a phase ends.
+
+        :param hook: the callable, `info' is a dict about what has been done (the file name for the file phases)
+        """
+        self.hooks.append(hook)
+
+    def remove_hook(self, hook):
+        self.hooks.remove(hook)
+
+    @contextmanager
+    def phase(self, name, **info):
+        """Times whatever is done inside the `with' block as a part of the phase `name'."""
+        start = _clock()
+        try:
+            yield
+        finally:
+            seconds = _clock() - start
+            with self._lock:
+                timing = self.timings.setdefault(name, [0., 0])
+                timing[0] += seconds
+                timing[1] += 1
+            for hook in self.hooks:
+                hook(name, seconds, info)
+
+    def timed(self, name):
+        """The decorator version of `phase'."""
+
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.phase(name):
+                    return func(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    def report(self):
+        # type: () -> str
+        """A human readable summary of the timings and the counters."""
+        lines = ["%-24s %10.3f ms %8d calls" % (name, timing[0] * 1000, timing[1])
+                 for name, timing in sorted(self.timings.items())]
+        lines += ["%-24s %10d" % (name, self.counters[name]) for name in sorted(self.counters)]
+        return "\n".join(lines)
+
+
+stats = Stats()
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+
+"""finding the extension of a file name among the known ones"""
+from typing import Dict, Iterable
+
+
+class SuffixTrie(object):
+    """The known extensions, spelled backwards in a trie, so that the longest one that a name ends with is found by
+    walking the name once from its end (and only as far as a known extension goes).
+
+    An extension can have dots in it ('test.sh'), it's matched only as a whole part of the name though: 'py' is the
+    extension of 'deploy.prod.py' but not of 'happy'.
+
+    basic usage:
+        >>> trie = SuffixTrie(["py", "sh", "test.sh"])
+        >>> trie.longest("deploy.prod.py"), trie.longest("x.test.sh"), trie.longest("x.txt")
+        ('py', 'test.sh', None)
+    """
+
+    # the trie of the last table it's been built of, see `of'
+    _last = (None, None)
+
+    def __init__(self, suffixes):
+        # type: (Iterable[str]) -> None
+        # {character: the same for the character before it}, the None key holds the extension that ends there
+        self.root = {}  # type: Dict
+        for suffix in suffixes:
+            node = self.root
+            for c in reversed(suffix):
+                node = node.setdefault(c, {})
+            node[None] = suffix
+
+    @staticmethod
+    def of(table):
+        # type: (Dict[str, Dict]) -> SuffixTrie
+        """:return: the trie of the extensions (keys) of `table', it's built once per table object (so it doesn't
+                    notice keys added to the same dict)"""
+        last_table, trie = SuffixTrie._last
+        if last_table is not table:
+            trie = SuffixTrie(table)
+            SuffixTrie._last = (table, trie)
+        return trie
+
+    def longest(self, name):
+        # type: (str) -> str or None
+        """:return: the longest known extension (without the dot) that `name' ends with, None if there's none"""
+        node = self.root
+        found = None
+        i = len(name)
+        while i > 0:
+            i -= 1
+            node = node.get(name[i])
+            if node is None:
+                break
+            if None in node and i > 0 and name[i - 1] == '.':
+                found = node[None]
+        return found
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+
+"""the virtualenvs of the projects the files are in"""
+import fnmatch
+import os
+import threading
+
+from typing import Dict, List
+
+from putshebang._stats import stats
+
+
+class VenvFinder(object):
+    """Finds the nearest virtualenv of a directory, that's a '.venv' or 'venv' in it or in one of its ancestors.
+
+    Every directory is looked at once, then it's remembered what it found (so are all the directories on the way up),
+    so a tree of thousands of files costs a couple of stats per directory at most.
+
+    basic usage:
+        >>> finder = VenvFinder().activate()
+        >>> finder.find("service/scripts")
+        '/home/user/project/service/.venv/bin'
+    """
+
+    NAMES = (".venv", "venv")
+
+    # the active finder, `ShebangedFile.get_extension' prefers what it finds
+    current = None  # type: VenvFinder
+
+    def __init__(self):
+        # {directory: the bin directory of its nearest virtualenv or None}
+        self.dirs = {}  # type: Dict[str, str]
+        # {bin directory: [names of the executables in it]}
+        self.files = {}  # type: Dict[str, List[str]]
+        self._lock = threading.Lock()
+
+    def find(self, directory):
+        # type: (str) -> str or None
+        """:return: the bin directory of the nearest virtualenv of `directory', None if there's none"""
+        d = os.path.abspath(directory)
+        walked = []
+        with self._lock:
+            while d not in self.dirs:
+                walked.append(d)
+                found = self._check(d)
+                if found is not None:
+                    break
+                parent = os.path.dirname(d)
+                if parent == d:
+                    break
+                d = parent
+            else:
+                found = self.dirs[d]
+
+            for w in walked:
+                self.dirs[w] = found
+        return found
+
+    @staticmethod
+    def _check(d):
+        # type: (str) -> str or None
+        stats.count("venv_dirs_checked")
+        for name in VenvFinder.NAMES:
+            if os.path.isfile(os.path.join(d, name, "pyvenv.cfg")):
+                return os.path.join(d, name, "bin")
+        return None
+
+    def which(self, bin_dir, pattern):
+        # type: (str, str) -> List[str]
+        """The same as `putshebang.which', but over the virtualenv's `bin_dir' only."""
+        with self._lock:
+            names = self.files.get(bin_dir)
+            if names is None:
+                try:
+                    names = sorted(e.name for e in os.scandir(bin_dir)
+                                   if not e.is_dir() and os.access(e.path, os.X_OK))
+                except OSError:
+                    names = []
+                stats.count("dirs_scanned")
+                self.files[bin_dir] = names
+        stats.count("executables_considered", len(names))
+        return [os.path.join(bin_dir, name) for name in fnmatch.filter(names, pattern)]
+
+    def activate(self):
+        # type: () -> VenvFinder
+        """Makes the interpreters of the nearest virtualenv of every file the preferred ones."""
+        VenvFinder.current = self
+        return self
+
+    @staticmethod
+    def deactivate():
+        # type: () -> None
+        VenvFinder.current = None
@@ -4,12 +4,30 @@
 from __future__ import print_function
 
 import argparse
+import json
 import os
 import re
 import sys
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from typing import Dict, Iterator, List, Tuple
 
 from putshebang import __version__
-from putshebang.shebangs import ShebangedFile, UnshebangedFile, ShebangNotFoundError, style
+from putshebang._discovery import Inventory, PathLister
+from putshebang._providers import ProviderIndex, PROVIDERS
+from putshebang._venv import VenvFinder
+from putshebang._journal import Journal
+from putshebang._lockfile import Lockfile
+from putshebang._profiles import PROFILES, apply_profile
+from putshebang._rewrite import RewriteTable, read_header
+from putshebang._startup import StartupTimer
+from putshebang._shard import PROBLEMS, merge_reports, parse_shard, shard_of
+from putshebang._state import AuditState
+from putshebang._stats import stats
+from putshebang.shebangs import ShebangedFile, UnshebangedFile, BufferFile, ShebangNotFoundError, \
+    ConcurrentModificationError, LOCK_TIMEOUT, style, _extension_of, _venv_of
 
 
 def info(msg):
@@ -44,10 +62,435 @@ def error(err, exit_code=1):
     sys.exit(exit_code)
 
 
-def cleanup(shebanged_file):
-    # type: (ShebangedFile) -> None
-    if shebanged_file is not None and shebanged_file.file.created:
-        os.remove(shebanged_file.file.name)
+def print_stats():
+    # type: () -> None
+    """prints the timings and the counters of the run to stderr"""
+    print(style("\n{INFO} {B}STATS{W}:\n") + stats.report(), file=sys.stderr)
+
+
+def choose_path(f, args):
+    # type: (str, argparse.Namespace) -> str
+    """finds the interpreters of the file `f' and picks one of them, asking the user when there's a choice to make
+
+    :return: the path of the chosen interpreter
+    """
+    # prompting would be mixed up with the records, or with the other files
+    interactive = args.format == 'text' and args.jobs <= 1 and not args.check
+    extension = ShebangedFile.get_extension(file_name=f, interpreter=args.lang, get_versions=True,
+                                            get_links=args.no_links)
+    interpreters = extension.interpreters
+
+    default_inter = interpreters["default"]
+    all_inters = ([default_inter] if default_inter else []) + interpreters["others"]
+    if not all_inters:
+        raise ShebangNotFoundError(
+            "the file name extension is not associated with any known interpreter name"
+        )
+
+    all_paths = [p for i in [p.all_paths for p in all_inters] for p in i]
+    if not all_paths:
+        s = '(' + re.sub(", (.+)$", "or \1", str([str(i) for i in all_inters])[1:-1]) + ')'
+        raise ShebangNotFoundError("interpreter for %s is not found in this machine's PATH" % s)
+
+    default_path = ''
+    comeout = False
+    for i in all_inters:
+        if comeout:
+            break
+        for p in i.paths:
+            if p.default_for_file:
+                default_path = p.path
+                comeout = True
+                break
+    if not default_path:
+        if default_inter:
+            default_path = default_inter.default_path.path
+        if args.prefer == 'fastest-startup' and len(all_paths) > 1 and Inventory.current is None:
+            # the interpreters of the virtualenv stay preferred, the fastest of them is taken then
+            venv = _venv_of(f)
+            paths = [p.path for p in all_paths]
+            default_path = StartupTimer.current.fastest([p for p in paths if os.path.dirname(p) == venv] or paths) \
+                or default_path
+
+    if args.default or not interactive or len(all_paths) == 1:
+        if not default_path:
+            raise ShebangNotFoundError("default interpreter not found on this machine's PATH")
+        path = default_path
+    else:
+        print(style(
+            "{INFO} Found {G}{n}{GR} interpreters for file {C}{file!r}{GR}: ", n=len(all_paths), file=f
+        ))
+
+        n = 1
+        for i in all_inters:
+            for p in i.all_paths:
+                default = ''
+                if p.default_for_ext:
+                    default = style(" {M}(default for the extension {G}'.{ext}'{M})", ext=i.extension)
+                elif p.default_for_file:
+                    default = style(" {M}(the default specified)")
+                elif p.default_for_inter:
+                    default = style(' {M}(default for interpreter {G}{inter!r}{M})', inter=str(i.name))
+
+                print(style("\t{Y}[{G}{n}{Y}]{GR}: {B}{path}" + default,
+                            n=n, path=p.path))
+                n += 1
+
+        print()
+        r = input(style(
+            "{GR}Choose one of the above paths {Y}[{G}1{Y}-{G}{n}{Y}] {GR}({G}[{R}ENTER{G}]{GR}"
+            " is the same as {Y}-d{GR}): ",
+            n=n - 1)
+        )
+
+        if r == '':
+            path = default_path
+        else:
+            path = all_paths[int(r) - 1]
+
+    return path
+
+
+class Audit(object):
+    """what --check needs to know across the files"""
+
+    def __init__(self, state=None, lockfile=None):
+        # type: (AuditState, Lockfile) -> None
+        """Constructor.
+
+        :param state: the verdicts of the last run, to be reused for the files that haven't changed since then
+        :param lockfile: the shebangs locked for the files, they're what the files should have (it's not updated)
+        """
+        self.state = state
+        self.lockfile = lockfile
+        # {(extension, virtualenv): the shebang or the error}, the interpreters are resolved once per extension
+        self.resolved = {}
+        self._lock = threading.Lock()
+
+    def expected(self, f, args):
+        # type: (str, argparse.Namespace) -> str
+        """:return: the shebang that `f' should have (without the newline)"""
+        if self.lockfile is not None:
+            locked = self.lockfile.lookup(f)
+            if locked is not None:
+                return locked["shebang"]
+        key = (_extension_of(f), _venv_of(f))
+        with self._lock:
+            if key not in self.resolved:
+                try:
+                    if args.env:
+                        self.resolved[key] = ShebangedFile.env_shebang(file_name=f, interpreter=args.lang,
+                                                                       args=args.env_args, must_exist=args.must_exist)
+                    else:
+                        self.resolved[key] = "#!" + choose_path(f, args)
+                    if args.flags:
+                        self.resolved[key] = apply_profile(self.resolved[key], args.flags)
+                except ShebangNotFoundError as e:
+                    self.resolved[key] = e
+            shebang = self.resolved[key]
+        if isinstance(shebang, Exception):
+            raise shebang
+        return shebang
+
+
+def check_file(f, args, audit):
+    # type: (str, argparse.Namespace, Audit) -> Dict
+    """the `process_file' of --check, the file is only read (if it has changed since the last run)
+
+    its 'status' is one of 'correct', 'wrong', 'missing' (there's no shebang at all) or 'failed'
+    """
+    record = {"file": f, "status": None, "shebang": None, "message": None}
+    try:
+        record["shebang"] = shebang = audit.expected(f, args)
+        if audit.state is not None:
+            verdict = audit.state.get(f, os.stat(f), shebang)
+            if verdict is not None:
+                stats.count("cache_hits")
+                record["status"] = verdict
+                return record
+            stats.count("cache_misses")
+
+        # the shebang is all that's checked, so the header is all that's read
+        header, st = read_header(f)
+        code = ShebangedFile(BufferFile(f, header), shebang=shebang + "\n").check_shebang()
+        record["status"] = AuditState.VERDICTS[code]
+        if audit.state is not None:
+            audit.state.put(f, st, shebang, record["status"])
+    except (OSError, IOError, ValueError, ShebangNotFoundError) as e:
+        stats.count("files_failed")
+        record.update(status="failed", message=str(e))
+    return record
+
+
+def process_file(f, args, journal=None, table=None, audit=None, lockfile=None):
+    # type: (str, argparse.Namespace, Journal, RewriteTable, Audit, Lockfile) -> Dict
+    """puts the shebang into the file `f' as the command line arguments say
+
+    :param journal: where to record the edit, if any
+    :param table: rewrite the shebang by the table rather than resolving a new one
+    :param audit: only check the shebang (see `check_file')
+    :param lockfile: take the shebang from it if it's there, record the chosen one into it otherwise
+    :return: a record of what happened, its 'status' is one of:
+        'written' -> the shebang has been put
+        'unchanged' -> the shebang has been put, but the file turned out to be the same
+        'correct' -> the correct shebang is already there
+        'wrong' -> there's a shebang pointing to a wrong interpreter, and --overwrite isn't given
+        'failed' -> something went wrong, 'message' says what
+        'conflict' -> the file kept being changed by someone else while it was being edited (`args.retries' times),
+                      nothing has been written
+        'duplicate' -> the file is the same as another one given before it (a hard link of it),
+                       'message' says which one
+    """
+    if audit is not None:
+        return check_file(f, args, audit)
+
+    shebang = None
+    if table is None:
+        try:
+            shebang = resolve_shebang(f, args, lockfile)
+        except Exception as e:
+            stats.count("files_failed")
+            return {"file": f, "status": "failed", "shebang": None, "message": str(e)}
+        except KeyboardInterrupt:
+            error(KeyboardInterrupt("Abort!"), 130)
+        except BaseException as e:
+            error(e, 2)
+
+    # a file that's been written by someone else in the meantime is read and done again (with the same shebang)
+    for _ in range(args.retries + 1):
+        if table is not None:
+            record = rewrite_file(f, args, table, journal)
+        else:
+            record = edit_file(f, args, shebang, journal)
+        if record["status"] != "conflict":
+            break
+        stats.count("conflicts")
+    return record
+
+
+def resolve_shebang(f, args, lockfile=None):
+    # type: (str, argparse.Namespace, Lockfile) -> str
+    """the shebang (without the newline) that `edit_file' puts into the file `f', taken from the lock if it's there
+
+    It's resolved before the file is opened, so the file isn't held (nor locked) while PATH is looked at or the user
+    is asked, and it's resolved once however many times the file is edited.
+    """
+    locked = lockfile.lookup(f) if lockfile is not None else None
+    if locked is not None:
+        return locked["shebang"]
+    if args.env:
+        # nothing to choose from, the name is all what we need
+        shebang = ShebangedFile.env_shebang(file_name=f, interpreter=args.lang, args=args.env_args,
+                                            must_exist=args.must_exist)
+    else:
+        shebang = "#!{}".format(choose_path(f, args))
+    if args.flags:
+        shebang = apply_profile(shebang, args.flags)
+    if lockfile is not None:
+        lockfile.record(f, shebang)
+    return shebang
+
+
+def edit_file(f, args, shebang, journal=None):
+    # type: (str, argparse.Namespace, str, Journal) -> Dict
+    """the `process_file' of a single try of putting the `shebang' (see `resolve_shebang') into the file `f'"""
+    record = {"file": f, "status": None, "shebang": shebang, "message": None}
+    try:
+        sf = ShebangedFile(UnshebangedFile(f, args.strict, args.executable, lock=not args.no_lock,
+                                           lock_timeout=args.lock_timeout), shebang=shebang + "\n")
+    except ConcurrentModificationError as e:
+        # it's been locked by someone else all along
+        record.update(status="conflict", message=e.strerror)
+        return record
+    except Exception as e:
+        stats.count("files_failed")
+        record.update(status="failed", message=str(e))
+        return record
+    except KeyboardInterrupt:
+        error(KeyboardInterrupt("Abort!"), 130)
+    except BaseException as e:
+        error(e, 2)
+
+    original = sf.file.original
+    code = sf.put_shebang(newline_count=args.newline, overwrite=args.overwrite)
+    with sf.file:
+        if code == 0:
+            try:
+                record["status"] = "written" if sf.file.save(preserve_mtime=args.preserve_mtime) else "unchanged"
+            except ConcurrentModificationError as e:
+                record.update(status="conflict", message=e.strerror)
+            except (OSError, IOError) as e:
+                stats.count("files_failed")
+                record.update(status="failed", message=str(e))
+        elif code == 1:
+            stats.count("files_skipped")
+            record["status"] = "correct"
+        elif code == 2:
+            stats.count("files_skipped")
+            record["status"] = "wrong"
+    if journal is not None and (sf.file.original is not original or sf.file.mode_change):
+        journal.record(f, original, sf.file.original, sf.file.mode_change, sf.file.created)
+    return record
+
+
+class ByteBudget(object):
+    """Limits the number of bytes being worked on at the same time."""
+
+    def __init__(self, limit):
+        # type: (int) -> None
+        self.limit = limit
+        self.used = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, n):
+        # type: (int) -> None
+        """waits until `n' more bytes fit, a file bigger than the whole budget goes when nothing else is there"""
+        with self._cond:
+            while self.used and self.used + n > self.limit:
+                self._cond.wait()
+            self.used += n
+
+    def release(self, n):
+        # type: (int) -> None
+        with self._cond:
+            self.used -= n
+            self._cond.notify_all()
+
+
+def rewrite_file(f, args, table, journal=None):
+    # type: (str, argparse.Namespace, RewriteTable, Journal) -> Dict
+    """the `process_file' of the rewrite mode, its 'status' is either 'written', 'unchanged', 'conflict' or 'failed'"""
+    record = {"file": f, "status": "unchanged", "shebang": None, "message": None}
+    try:
+        edit = table.rewrite_file(f, preserve_mtime=args.preserve_mtime, lock=not args.no_lock,
+                                  lock_timeout=args.lock_timeout)
+    except ConcurrentModificationError as e:
+        record.update(status="conflict", message=e.strerror)
+        return record
+    except (OSError, IOError, ValueError) as e:
+        stats.count("files_failed")
+        record.update(status="failed", message=str(e))
+        return record
+
+    if edit is not None:
+        old, new = edit
+        record.update(status="written", shebang=new.decode('latin-1'))
+        if journal is not None:
+            journal.record(f, old, new)
+    return record
+
+
+def stat_once(f, seen):
+    # type: (str, Dict[Tuple[int, int], str]) -> Tuple[os.stat_result, Dict]
+    """stats the file `f', remembering its inode in `seen' ({inode: the file})
+
+    :return: (its stat or None if it can't be stat-ed, a 'duplicate' record if its inode has been seen before or None)
+    """
+    try:
+        st = os.stat(f)
+    except OSError:
+        # process_file will tell what's wrong with it (or create it)
+        return None, None
+
+    inode = (st.st_dev, st.st_ino)
+    if inode in seen:
+        return st, {"file": f, "status": "duplicate", "shebang": None,
+                    "message": "the same file as {!r}".format(seen[inode])}
+    seen[inode] = f
+    return st, None
+
+
+def process_serially(files, args, journal=None, table=None, audit=None, lockfile=None):
+    # type: (List[str], argparse.Namespace, Journal, RewriteTable, Audit, Lockfile) -> Iterator[Dict]
+    """`process_file' for every file in `files', one after another, every inode is processed only once (the same
+    records as `process_files' gives)"""
+    seen = {}
+    for f in files:
+        st, duplicate = stat_once(f, seen)
+        yield duplicate if duplicate is not None else process_file(f, args, journal, table, audit, lockfile)
+
+
+def process_files(files, args, journal=None, table=None, audit=None, lockfile=None):
+    # type: (List[str], argparse.Namespace, Journal, RewriteTable, Audit, Lockfile) -> Iterator[Dict]
+    """`process_file' for every file in `files', in a pool of `args.jobs' threads
+
+    The records are yielded in the order of `files', every inode is processed only once and at most
+    `args.max_inflight' bytes of files are read at the same time.
+    """
+    budget = ByteBudget(args.max_inflight * 1024 * 1024)
+    seen = {}
+    pending = deque()
+
+    def job(f, size):
+        try:
+            return process_file(f, args, journal, table, audit, lockfile)
+        finally:
+            budget.release(size)
+
+    with ThreadPoolExecutor(max_workers=args.jobs) as pool:
+        for f in files:
+            st, duplicate = stat_once(f, seen)
+            if duplicate is not None:
+                pending.append(duplicate)
+                continue
+
+            size = st.st_size if st is not None else 0
+            budget.acquire(size)
+            pending.append(pool.submit(job, f, size))
+
+            # don't let the finished ones pile up
+            while pending and (len(pending) > args.jobs * 4 or not isinstance(pending[0], Future)
+                               or pending[0].done()):
+                head = pending.popleft()
+                yield head.result() if isinstance(head, Future) else head
+
+        while pending:
+            head = pending.popleft()
+            yield head.result() if isinstance(head, Future) else head
+
+
+def print_record(record):
+    # type: (Dict) -> None
+    """prints a record of `process_file' for humans"""
+    if record["status"] in ("failed", "conflict"):
+        warn(style("file: {G}{file}{W}: {GR}{msg}", file=record["file"], msg=record["message"]))
+    elif record["status"] == "correct":
+        info(style("file: {G}{file}{W}: {GR}the correct shebang is already there.", file=record["file"]))
+    elif record["status"] == "duplicate":
+        info(style("file: {G}{file}{W}: {GR}{msg}, skipped.", file=record["file"], msg=record["message"]))
+    elif record["status"] == "missing":
+        warn(style("file: {G}{file}{W}: {GR}there's no shebang in the file", file=record["file"]))
+    elif record["status"] == "wrong":
+        warn(style(
+            "file: {G}{file}{W}: {GR}There's a shebang in the file, but it's pointing to a wrong interpreter\n"
+            "{INFO} use the option {G}--overwrite{GR} to overwrite it", file=record["file"]
+        ))
+
+
+def print_summary(summary):
+    # type: (Dict) -> None
+    """prints what `merge_reports' returns for humans"""
+    counts = ", ".join(style("{G}{n}{GR} {status}", n=n, status=status)
+                       for status, n in sorted(summary["status"].items()))
+    info(style("{G}{n}{GR} files: ", n=summary["files"]) + counts)
+    for record in summary["problems"]:
+        print_record(record)
+
+
+def shard(text):
+    # type: (str) -> Tuple[int, int]
+    """the argparse type of --shard"""
+    try:
+        return parse_shard(text)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+
+def print_json(record):
+    # type: (Dict) -> None
+    """prints a record as one line of json, right away"""
+    sys.stdout.write(json.dumps(record, separators=(',', ':'), sort_keys=True) + "\n")
+    sys.stdout.flush()
 
 
 def main(args_=None):
@@ -68,6 +511,14 @@ def main(args_=None):
     info_g.add_argument("-k", "--known", metavar="FORMAT",
                         help="print known extensions in the format of a FORMAT, "
                              "FORMAT can be 'tree' or 'table'")
+    info_g.add_argument("-f", "--format", choices=("text", "jsonl"), default="text",
+                        help="'jsonl' prints one json record per line for every path of --known or for every "
+                             "FILE, as soon as it's known, and never prompts (as if -d was given); "
+                             "default is 'text'")
+    info_g.add_argument("--merge", action="store_true",
+                        help="the FILEs are the jsonl reports of the shards of a run (see --shard), summarize them")
+    info_g.add_argument("-S", "--stats", action="store_true",
+                        help="print the time spent in every phase and what has been done to stderr")
     info_g.add_argument("-v", "--version", action="version", version="%(prog)s: {}".format(__version__))
     info_g.add_argument("-h", "--help", action="help", help="show this help message and exit")
 
@@ -89,119 +540,263 @@ def main(args_=None):
                              "however, 2 is recommended")
     edit_g.add_argument("-l", "--lang", metavar="LANG",
                         help="forces the name of the language's interpreter to be LANG")
+    edit_g.add_argument("-e", "--env", action="store_true",
+                        help="use '/usr/bin/env NAME' as the shebang, where NAME is --lang or the default interpreter "
+                             "of the extension; PATH isn't searched at all")
+    edit_g.add_argument("-A", "--env-args", metavar="ARGS",
+                        help="with --env, pass ARGS to the interpreter (by 'env -S')")
+    edit_g.add_argument("--flags", metavar="PROFILE", choices=sorted(PROFILES),
+                        help="put the flags of PROFILE after the interpreter (through 'env -S' if they're more than "
+                             "one argument), out of: {}; 'startup' makes short lived scripts start faster, a shebang "
+                             "that already has the flags is correct".format(", ".join(sorted(PROFILES))))
+    edit_g.add_argument("-m", "--must-exist", action="store_true",
+                        help="with --env, make sure that NAME is on PATH")
+    edit_g.add_argument("-p", "--preserve-mtime", action="store_true",
+                        help="keep the original modification time of the files that get rewritten")
+    edit_g.add_argument("-R", "--rewrite", metavar="TABLE",
+                        help="only rewrite the shebangs that match the json object of {OLD: NEW} in the file TABLE, "
+                             "where OLD is a pattern (with '*' and such) of the whole shebang line (without the '#!') "
+                             "and NEW replaces it; nothing is resolved and the other files are left as they are")
+    edit_g.add_argument("-M", "--map", metavar="OLD=NEW", action="append",
+                        help="the same as --rewrite but for a single pattern, can be given many times")
+    edit_g.add_argument("-J", "--journal", metavar="JOURNAL",
+                        help="record the edits into JOURNAL (appending to it), so that they can be undone")
+    edit_g.add_argument("-u", "--undo", metavar="JOURNAL",
+                        help="undo the edits recorded in JOURNAL, the FILEs aren't needed")
+    edit_g.add_argument("-L", "--lockfile", metavar="LOCK",
+                        help="take the shebangs from LOCK for the files that are there, and record the chosen ones "
+                             "into it for the others, so that they're chosen only once; '{}' is used if it's in the "
+                             "current directory".format(Lockfile.NAME))
+    edit_g.add_argument("--no-lockfile", action="store_true",
+                        help="don't use '{}' even if it's there".format(Lockfile.NAME))
+    edit_g.add_argument("-c", "--check", action="store_true",
+                        help="only check the shebangs, nothing is written (never prompts, as if -d was given)")
+    edit_g.add_argument("--state", metavar="FILE",
+                        help="with --check, keep the verdicts in FILE, and check only the files that have changed "
+                             "since the last run (or whose interpreter has)")
     edit_g.add_argument("-n", "--newline", metavar="N", type=int, default=1,
                         help="number of newlines to be put after the shebang; default is 1")
+    edit_g.add_argument("--no-lock", action="store_true",
+                        help="don't take an advisory lock (flock) of every file while it's being edited, the file is "
+                             "still written only if nobody has changed it since it was read")
+    edit_g.add_argument("--lock-timeout", metavar="SECONDS", type=float, default=LOCK_TIMEOUT,
+                        help="wait up to SECONDS for a file that someone else has locked, it's reported as a "
+                             "'conflict' after that; default is %(default)s")
+    edit_g.add_argument("--retries", metavar="N", type=int, default=3,
+                        help="edit a file again up to N times if someone else changes it in the meantime, it's "
+                             "reported as a 'conflict' after that; default is 3")
+
+    discovery_g = parser.add_argument_group("DISCOVERY")
+    discovery_g.add_argument("--export-inventory", metavar="FILE",
+                             help="save the executables found on PATH into FILE (to be used by --inventory) and exit")
+    source_g = discovery_g.add_mutually_exclusive_group()
+    source_g.add_argument("--inventory", metavar="FILE",
+                          help="look for the interpreters in FILE (as saved by --export-inventory) rather than "
+                               "on this machine's PATH")
+    source_g.add_argument("-r", "--root", metavar="DIR",
+                          help="look for the interpreters in the PATH directories inside DIR (an unpacked image or a "
+                               "chroot), the shebangs are relative to DIR")
+    discovery_g.add_argument("--path-timeout", metavar="SECONDS", type=float, default=2.,
+                             help="skip the PATH directories that take longer than SECONDS to be listed (stalled "
+                                  "network mounts), they're reported; default is 2")
+    discovery_g.add_argument("-P", "--providers", metavar="NAMES",
+                             help="look for the interpreters in the installs of these version managers as well (after "
+                                  "PATH), NAMES are comma separated out of: {} or 'all'; the installs are indexed once "
+                                  "and kept in {}".format(", ".join(sorted(PROVIDERS)),
+                                                          ProviderIndex.default_cache_file()))
+    discovery_g.add_argument("-V", "--venv", action="store_true",
+                             help="prefer the interpreters of the nearest virtualenv ('.venv' or 'venv' in the "
+                                  "directory of the FILE or above it), they're the default then")
+    discovery_g.add_argument("--prefer", metavar="POLICY", choices=("first", "fastest-startup"), default="first",
+                             help="how the default interpreter is chosen when there are many: 'first' is the first "
+                                  "one found on PATH, 'fastest-startup' is the one that starts the fastest (every "
+                                  "interpreter is timed once, and again only once it changes, the timings are kept "
+                                  "in {}); default is 'first'".format(StartupTimer.default_cache_file()))
+
+    perf_g = parser.add_argument_group("PERFORMANCE")
+    perf_g.add_argument("-j", "--jobs", metavar="N", type=int, default=1,
+                        help="work on N files at the same time (never prompts, as if -d was given); default is 1")
+    perf_g.add_argument("--max-inflight", metavar="MIB", type=int, default=64,
+                        help="with --jobs, the maximum size of the files being worked on at the same time, "
+                             "in MiB; default is 64")
+    perf_g.add_argument("--shard", metavar="I/N", type=shard,
+                        help="work only on the I-th of N shards of the FILEs (I counts from 1), the files are split by "
+                             "a hash of their paths relative to the current directory, the same way on every machine")
 
     # data_g = parser.add_argument_group("DATA")
     # data_g.add_argument("-a", "--add", metavar="ext=inter")
 
     args = parser.parse_args(args=args_)
 
+    PathLister.current.timeout = args.path_timeout
+    try:
+        return run(parser, args)
+    finally:
+        for d in sorted(PathLister.current.slow):
+            warn(style("PATH directory {G}{d}{GR} didn't answer within {t} seconds, it has been skipped",
+                       d=d, t=args.path_timeout))
+        # the discovery settings are for this run only
+        Inventory.deactivate()
+        ProviderIndex.deactivate()
+        VenvFinder.deactivate()
+        StartupTimer.deactivate()
+
+
+def run(parser, args):
+    # type: (argparse.ArgumentParser, argparse.Namespace) -> int
+    """does what the parsed command line arguments say
+
+    :return: the exit code
+    """
     # return status
     rs = 0
+    if args.export_inventory:
+        with open(args.export_inventory, 'w') as f:
+            Inventory.scan(root=args.root).dump(f)
+        return rs
+
+    if args.root:
+        if not os.path.isdir(args.root):
+            error(ValueError("root {!r} is not a directory".format(args.root)))
+        Inventory.scan(root=args.root).activate()
+
+    if args.inventory:
+        try:
+            with open(args.inventory) as f:
+                Inventory.load(f).activate()
+        except (OSError, IOError, ValueError) as e:
+            error(e)
+
+    if args.providers:
+        names = sorted(PROVIDERS) if args.providers == 'all' else [n.strip() for n in args.providers.split(",")]
+        try:
+            ProviderIndex(names, cache_file=ProviderIndex.default_cache_file()).activate()
+        except ValueError as e:
+            error(e)
+
+    if args.venv:
+        VenvFinder().activate()
+
+    if args.prefer == 'fastest-startup':
+        if args.root or args.inventory:
+            # their interpreters are of another machine (or an image), they can't be run here
+            parser.print_usage()
+            error(argparse.ArgumentError(None, "--prefer fastest-startup doesn't go with --root or --inventory"), 2)
+        StartupTimer(cache_file=StartupTimer.default_cache_file()).activate()
+
     if args.known:
-        ShebangedFile.print_known(args.no_links, args.known)
+        if args.format == 'jsonl':
+            for record in ShebangedFile.iter_known(args.no_links):
+                print_json(record)
+        else:
+            ShebangedFile.print_known(args.no_links, args.known)
+        if args.stats:
+            print_stats()
         return rs
 
-    if not args.file:
+    if not args.file and not args.undo:
         parser.print_usage()
         error(argparse.ArgumentError(None, "FILE is required"), 2)
+    if args.jobs < 1:
+        parser.print_usage()
+        error(argparse.ArgumentError(None, "--jobs must be at least 1"), 2)
 
-    sf = None
-    for f in args.file:
+    if args.merge:
+        reports = []
         try:
-            sf = ShebangedFile(UnshebangedFile(f, args.strict, args.executable))
-            extension = sf.get_extension(interpreter=args.lang, get_versions=True,
-                                         get_links=args.no_links)
-            interpreters = extension.interpreters
-
-            default_inter = interpreters["default"]
-            all_inters = ([default_inter] if default_inter else []) + interpreters["others"]
-            if not all_inters:
-                raise ShebangNotFoundError(
-                    "the file name extension is not associated with any known interpreter name"
-                )
-
-            all_paths = [p for i in [p.all_paths for p in all_inters] for p in i]
-            if not all_paths:
-                s = '(' + re.sub(", (.+)$", "or \1", str([str(i) for i in all_inters])[1:-1]) + ')'
-                raise ShebangNotFoundError("interpreter for %s is not found in this machine's PATH" % s)
-
-            default_path = ''
-            comeout = False
-            for i in all_inters:
-                if comeout:
-                    break
-                for p in i.paths:
-                    if p.default_for_file:
-                        default_path = p.path
-                        comeout = True
-                        break
-            if not default_path:
-                if default_inter:
-                    default_path = default_inter.default_path.path
-
-            if args.default or len(all_paths) == 1:
-                if not default_path:
-                    raise ShebangNotFoundError("default interpreter not found on this machine's PATH")
-                path = default_path
-            else:
-                print(style(
-                    "{INFO} Found {G}{n}{GR} interpreters for file {C}{file!r}{GR}: ", n=len(all_paths), file=f
-                ))
-
-                n = 1
-                for i in all_inters:
-                    for p in i.all_paths:
-                        default = ''
-                        if p.default_for_ext:
-                            default = style(" {M}(default for the extension {G}'.{ext}'{M})", ext=i.extension)
-                        elif p.default_for_file:
-                            default = style(" {M}(the default specified)")
-                        elif p.default_for_inter:
-                            default = style(' {M}(default for interpreter {G}{inter!r}{M})', inter=str(i.name))
-
-                        print(style("\t{Y}[{G}{n}{Y}]{GR}: {B}{path}" + default,
-                                    n=n, path=p.path))
-                        n += 1
-
-                print()
-                r = input(style(
-                    "{GR}Choose one of the above paths {Y}[{G}1{Y}-{G}{n}{Y}] {GR}({G}[{R}ENTER{G}]{GR}"
-                    " is the same as {Y}-d{GR}): ",
-                    n=n - 1)
-                )
-
-                if r == '':
-                    path = default_path
-                else:
-                    path = all_paths[int(r) - 1]
-
-            sf.shebang = "#!{}\n".format(path)
-        except Exception as e:
-            cleanup(sf)
-            warn(style("file: {G}{file}{W}: {GR}{msg}", file=f, msg=e))
-            rs = 1
-            continue
-        except KeyboardInterrupt:
-            cleanup(sf)
-            error(KeyboardInterrupt("Abort!"), 130)
-        except BaseException as e:
-            cleanup(sf)
-            error(e, 2)
+            for f in args.file:
+                reports.append(open(f))
+            summary = merge_reports(reports)
+        except (OSError, IOError) as e:
+            error(e)
+        except (ValueError, KeyError) as e:
+            error(ValueError("not a jsonl report: {}".format(e)))
+        finally:
+            for report in reports:
+                report.close()
+        if args.format == 'jsonl':
+            print_json(summary)
+        else:
+            print_summary(summary)
+        return 1 if summary["problems"] else rs
+
+    files = args.file
+    if args.shard:
+        index, count = args.shard
+        files = [f for f in files if shard_of(f, count) == index]
+
+    table = None
+    if args.rewrite or args.map:
+        mapping = {}
+        try:
+            if args.rewrite:
+                with open(args.rewrite) as f:
+                    mapping.update(RewriteTable.load(f).mapping)
+            for m in args.map or ():
+                old, sep, new = m.partition('=')
+                if not sep:
+                    raise ValueError("--map must look like OLD=NEW, not {!r}".format(m))
+                mapping[old] = new
+        except (OSError, IOError, ValueError) as e:
+            error(e)
+        table = RewriteTable(mapping)
+
+    lockfile = None
+    lock_name = args.lockfile or (Lockfile.NAME if os.path.isfile(Lockfile.NAME) and not args.no_lockfile else None)
+    if lock_name and not args.undo and table is None:
+        try:
+            lockfile = Lockfile(lock_name)
+        except (OSError, IOError, ValueError) as e:
+            error(e)
+
+    audit = None
+    if args.check:
+        if table is not None or args.journal or args.undo:
+            parser.print_usage()
+            error(argparse.ArgumentError(None, "--check doesn't go with --rewrite, --map, --journal or --undo"), 2)
+        state = None
+        if args.state:
+            # the verdicts depend on the language table and on how the interpreters are chosen, the interpreters
+            # themselves are checked per entry
+            key = AuditState.make_key(ShebangedFile.ALL_INTERS, args.lang, args.env, args.env_args, args.no_links,
+                                      args.flags)
+            state = AuditState.load(args.state, key)
+        audit = Audit(state, lockfile)
+    elif args.state:
+        parser.print_usage()
+        error(argparse.ArgumentError(None, "--state needs --check"), 2)
 
-        code = sf.put_shebang(newline_count=args.newline, overwrite=args.overwrite)
-        if code == 0:
-            sf.file.save()
-        elif code == 1:
-            info(style("file: {G}{file}{W}: {GR}the correct shebang is already there.", file=f))
-            rs = 0
-        elif code == 2:
-            warn(style(
-                "file: {G}{file}{W}: {GR}There's a shebang in the file, but it's pointing to a wrong interpreter\n"
-                "{INFO} use the option {G}--overwrite{GR} to overwrite it", file=f
-            ))
-            rs = 1
+    journal = None
+    if args.journal:
+        try:
+            journal = Journal(args.journal)
+        except (OSError, IOError) as e:
+            error(e)
+
+    emit = print_json if args.format == 'jsonl' else print_record
+    if args.undo:
+        records = Journal.undo(args.undo)
+    elif args.jobs > 1:
+        records = process_files(files, args, journal, table, audit, lockfile)
+    else:
+        records = process_serially(files, args, journal, table, audit, lockfile)
+    try:
+        for record in records:
+            if record["status"] in PROBLEMS:
+                rs = 1
+            emit(record)
+    finally:
+        if journal is not None:
+            journal.close()
+        if lockfile is not None:
+            lockfile.close()
+    if audit is not None and audit.state is not None:
+        try:
+            audit.state.save(args.state)
+        except (OSError, IOError) as e:
+            error(e)
+    if args.stats:
+        print_stats()
     return rs
 
 
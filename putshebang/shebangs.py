@@ -4,38 +4,306 @@
 
 from __future__ import print_function as _
 
-import glob as _glob
+import errno as _errno
+import fnmatch as _fnmatch
 import os as _os
 import re as _re
+import stat as _stat
 import sys as _sys
+import time as _time
 from collections import namedtuple as _nt
+from itertools import chain as _chain
 
-from typing import List, Dict
+from typing import Dict, Iterator, List, Tuple
 from wcwidth import wcswidth as _wcswidth
 
 from putshebang._data import Data as _Data
+from putshebang._discovery import Inventory as _Inventory, PathLister as _PathLister
+from putshebang._providers import ProviderIndex as _ProviderIndex
+from putshebang._venv import VenvFinder as _VenvFinder
+from putshebang._stats import stats as _stats
+from putshebang._suffix import SuffixTrie as _SuffixTrie
 
 
 # compatibility
 if _sys.version_info.major < 3:
     input = raw_input
 
+try:
+    import fcntl as _fcntl
+except ImportError:
+    # no advisory locks then, the size and mtime checks of `UnshebangedFile.save' are still there
+    _fcntl = None
+
+# what flock fails with where the file system has no locks
+_NO_LOCKS = tuple(getattr(_errno, name) for name in ("ENOLCK", "EOPNOTSUPP", "ENOTSUP", "ENOSYS", "EINVAL")
+                  if hasattr(_errno, name))
+# the seconds to wait for the lock of a file that someone else holds, it's a 'conflict' after that
+LOCK_TIMEOUT = 10.0
+
+_clock = getattr(_time, "monotonic", _time.time)
+
 
 # ========================== Some Utilities ==========================
+BOM = b"\xef\xbb\xbf"
+ENV = "/usr/bin/env"
+
+
+def _to_bytes(text):
+    # type: (str or bytes) -> bytes
+    """Encodes `text' the same way the file system does (paths in shebangs are file names after all)."""
+    if isinstance(text, bytes):
+        return text
+    # there's no os.fsencode before Python 3.2
+    if not hasattr(_os, "fsencode"):
+        return text.encode(_sys.getfilesystemencoding() or 'utf-8')
+    return _os.fsencode(text)
+
+
+@_stats.timed("discovery")
 def which(cmd):
     # type: (str) -> List[str]
-    """Like shutil.which, but uses globs, and less features."""
+    """Like shutil.which, but uses globs, and less features.
+
+    The PATH directories are listed by `PathLister.current' (the slow ones are skipped), and the matches are checked
+    to still be executable. The installs of the active `ProviderIndex' (if any) come after them.
+    """
+
+    if _Inventory.current is not None:
+        return _Inventory.current.which(cmd)
 
-    paths = _os.environ.get("PATH", _os.defpath).split(":")
     l = []
-    for path in paths:
-        abs_path = _os.path.join(path, cmd)
-        g = list(filter(lambda f: (not _os.path.isdir(f) and _os.access(f, _os.F_OK | _os.X_OK)), _glob.glob(abs_path)))
-        if len(g) != 0:
-            l.extend(g)
+    for path, names in _PathLister.current.listings(_os.environ.get("PATH", _os.defpath).split(":")):
+        _stats.count("executables_considered", len(names))
+        # globs don't match hidden files unless asked to
+        l.extend(_os.path.join(path, name) for name in _fnmatch.filter(names, cmd)
+                 if (not name.startswith('.') or cmd.startswith('.'))
+                 and _PathLister.current.executable(path, name))
+    if _ProviderIndex.current is not None:
+        l.extend(_ProviderIndex.current.which(cmd))
     return l
 
 
+def _iter_which(cmd):
+    # type: (str) -> Iterator[str]
+    """`which', lazily: the PATH directories are listed one by one, only as far as the paths are consumed"""
+    if _Inventory.current is not None:
+        # it's all in memory already
+        for path in _Inventory.current.which(cmd):
+            yield path
+        return
+
+    for d in _os.environ.get("PATH", _os.defpath).split(":"):
+        for path, names in _PathLister.current.listings([d]):
+            _stats.count("executables_considered", len(names))
+            for name in _fnmatch.filter(names, cmd):
+                if (not name.startswith('.') or cmd.startswith('.')) and _PathLister.current.executable(path, name):
+                    yield _os.path.join(path, name)
+    if _ProviderIndex.current is not None:
+        for path in _ProviderIndex.current.which(cmd):
+            yield path
+
+
+def iter_shebangs(file_name=None, interpreter=None, get_versions=False):
+    # type: (str, str, bool) -> Iterator[str]
+    """Yields the shebangs of `file_name' (or `interpreter') as they're found, the best one first.
+
+    That's the order the default is chosen by: `interpreter' (if given), then the default interpreter of the
+    extension, then its other interpreters; and for each of them, the nearest virtualenv (see `VenvFinder') then PATH
+    in order. Nothing is looked for before it's asked for, so `next(iter_shebangs("file.py"))' stops at the first
+    PATH directory that has python, and never looks for the other interpreters.
+
+    :param file_name: the file name to get the extension from
+    :param interpreter: the interpreter (and maybe its version) to look for first, the extension it's associated with
+                        (if any) takes precedence over the one of `file_name'
+    :param get_versions: yield the other versions of every interpreter as well (after its wanted one)
+    """
+    version_regex = r'^%s-?(\d{1,4}(\.\d{1,2}(\.\d)?)?)?$'
+    all_data = ShebangedFile.ALL_INTERS
+
+    wanted = []
+    extension = _extension_of(file_name or '')
+    if interpreter is not None:
+        match = _re.match(version_regex % r'(\w+)', interpreter)
+        if match is None:
+            raise ValueError("%r is not an interpreter name" % interpreter)
+        wanted.append((match.group(1), match.group(2) or ''))
+        for ext in all_data:
+            if any(i["name"] == wanted[0][0] for i in [all_data[ext]["default"]] + all_data[ext]["others"]):
+                extension = ext
+                break
+    if extension in all_data:
+        entry = all_data[extension]
+        wanted.extend((i["name"], i["version"]) for i in [entry["default"]] + entry["others"])
+
+    venv = _venv_of(file_name)
+    seen = set()
+    for name, version in wanted:
+        exact = _re.compile(r'^{}-?{}$'.format(_re.escape(name), _re.escape(version)))
+        versions = _re.compile(version_regex % _re.escape(name))
+        venv_paths = _VenvFinder.current.which(venv, name + "*") if venv else []
+        others = []
+        found = False
+        for path in _chain(venv_paths, _iter_which(name + "*")):
+            executable = _os.path.basename(path)
+            # any version of the virtualenv is the one it wants
+            if not found and (exact.match(executable) or path in venv_paths and versions.match(executable)):
+                _stats.count("regex_matches")
+                found = True
+                if path not in seen:
+                    seen.add(path)
+                    yield "#!" + path
+                if not get_versions:
+                    break
+            elif get_versions and versions.match(executable):
+                _stats.count("regex_matches")
+                others.append(path)
+
+        for path in sorted(others, reverse=True):
+            if path not in seen:
+                seen.add(path)
+                yield "#!" + path
+
+
+def _lookup(cmd):
+    # type: (str) -> str or None
+    """:return: the first executable named exactly `cmd' on PATH (or None), no globbing nor listing is done, just a
+                stat per directory until it's found (see `PathLister.lookup')"""
+    if _Inventory.current is not None:
+        return next(iter(_Inventory.current.which(cmd)), None)
+
+    path = _PathLister.current.lookup(_os.environ.get("PATH", _os.defpath).split(":"), cmd)
+    return None if path is None else _os.path.join(path, cmd)
+
+
+def _read_fd(fd, size):
+    # type: (int, int) -> bytes
+    """reads (up to) `size' bytes from the current position of `fd'"""
+    chunks = []
+    while size > 0:
+        chunk = _os.read(fd, size)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+def _write_fd(fd, data):
+    # type: (int, bytes) -> None
+    """replaces the whole contents of `fd' by `data'"""
+    _os.lseek(fd, 0, _os.SEEK_SET)
+    view = memoryview(data)
+    while view:
+        view = view[_os.write(fd, view):]
+    _os.ftruncate(fd, len(data))
+
+
+def _lock_fd(fd, timeout=LOCK_TIMEOUT):
+    # type: (int, float) -> None
+    """takes an exclusive advisory lock of `fd', waiting up to `timeout' seconds for whoever holds it (it goes away
+    once `fd' is closed)
+
+    Where there are no locks (no fcntl, or a file system that doesn't support them, like some NFS and FUSE mounts)
+    nothing is done, the checks of `_check_unchanged' are still there.
+
+    :raise ConcurrentModificationError: if it's still held by someone else after `timeout' seconds
+    """
+    if _fcntl is None:
+        return
+    deadline = None
+    delay = 0.001
+    while True:
+        try:
+            _fcntl.flock(fd, _fcntl.LOCK_EX | _fcntl.LOCK_NB)
+            return
+        except (OSError, IOError) as e:
+            if e.errno in _NO_LOCKS:
+                _stats.count("locks_unsupported")
+                return
+            if e.errno not in (_errno.EAGAIN, _errno.EACCES, _errno.EWOULDBLOCK):
+                raise
+        # polled rather than waited for, a blocking flock can't be given up on
+        if deadline is None:
+            _stats.count("lock_waits")
+            deadline = _clock() + timeout
+        elif _clock() >= deadline:
+            raise ConcurrentModificationError(_errno.EAGAIN, "the file is locked by someone else")
+        _time.sleep(delay)
+        delay = min(delay * 2, 0.05)
+
+
+def _check_unchanged(fd, name, st):
+    # type: (int, str, _os.stat_result) -> None
+    """makes sure that the file `name' (opened as `fd') is still what it was when its stat was `st'
+
+    :raise ConcurrentModificationError: if it has been written or replaced since then
+    """
+    now = _os.fstat(fd)
+    if (now.st_ino, now.st_size, now.st_mtime_ns) != (st.st_ino, st.st_size, st.st_mtime_ns):
+        raise ConcurrentModificationError(_errno.EAGAIN, "the file has been modified since it was read", name)
+    try:
+        current = _os.stat(name)
+    except OSError:
+        current = None
+    if current is None or (current.st_dev, current.st_ino) != (now.st_dev, now.st_ino):
+        raise ConcurrentModificationError(_errno.EAGAIN, "the file has been replaced since it was read", name)
+
+
+def _split_flags(words):
+    # type: (List[str]) -> set
+    """:return: the flags in `words', with the short ones that are put together split ('-Es' is '-E' and '-s')"""
+    flags = set()
+    for word in words:
+        if _re.match(r"^-[A-Za-z]{2,}$", word):
+            flags.update('-' + c for c in word[1:])
+        else:
+            flags.add(word)
+    return flags
+
+
+def _command_of(shebang):
+    # type: (str) -> Tuple[str, set]
+    """:return: the interpreter that `shebang' runs (looking through 'env -S') and the flags it's given"""
+    words = shebang[2:].split()
+    if words and words[0] == ENV:
+        words = words[2:] if words[1:2] == ["-S"] else words[1:]
+    return (words[0] if words else ''), _split_flags(words[1:])
+
+
+def _extension_of(file_name):
+    # type: (str) -> str
+    """:return: the longest known extension of `file_name' (without the dot), its last one if none of them is known,
+                or '' if it has none ('deploy.prod.py' is 'py', 'x.test.sh' is 'test.sh' only if that's known)"""
+    name = _os.path.basename(file_name)
+    extension = _SuffixTrie.of(ShebangedFile.ALL_INTERS).longest(name)
+    if extension is None:
+        dot = name.rfind('.')
+        extension = name[dot + 1:] if dot != -1 else ''
+    return extension
+
+
+def _venv_of(file_name):
+    # type: (str) -> str or None
+    """:return: the bin directory of the nearest virtualenv of `file_name', if a `VenvFinder' is active"""
+    if _VenvFinder.current is None or _Inventory.current is not None or not file_name:
+        # the virtualenvs are on this machine, an inventory is of some other one
+        return None
+    return _VenvFinder.current.find(_os.path.dirname(file_name) or _os.curdir)
+
+
+def _link_info(path):
+    # type: (str) -> (bool, str)
+    """:return: whether `path' is a link, and its real path"""
+    if not path:
+        return False, ''
+    if _Inventory.current is not None:
+        return _Inventory.current.link_info(path)
+    _stats.count("lstat_calls")
+    _stats.count("realpath_calls")
+    return _os.path.islink(path), _os.path.realpath(path)
+
+
 class Style:
     """Decorator of text, mainly used as a callable"""
 
@@ -121,6 +389,10 @@ class ShebangNotFoundError(Exception):
     pass
 
 
+class ConcurrentModificationError(OSError):
+    """The file has been changed by someone else between reading and writing it, nothing has been written."""
+
+
 Extension = _nt("Extension", ["name", "interpreters"])
 Extension.__doc__ = "The extension that will have all the associated interpreters."
 
@@ -218,8 +490,7 @@ class InterpreterPath(object):
         self.default_for_ext = default_for_ext
         self.default_for_inter = default_for_inter
         self.default_for_file = default_for_file
-        self.islink = _os.path.islink(path)
-        self.realpath = _os.path.realpath(path) if path else ''
+        self.islink, self.realpath = _link_info(path)
 
     @property
     def path(self):
@@ -228,8 +499,7 @@ class InterpreterPath(object):
     @path.setter
     def path(self, val):
         self._path = val
-        self.islink = _os.path.islink(val)
-        self.realpath = _os.path.realpath(val)
+        self.islink, self.realpath = _link_info(val)
 
     def __str__(self):
         return str(self.path)
@@ -258,62 +528,223 @@ class UnshebangedFile(object):
     Generally, it should only be used when it's passed to the `ShebangedFile` constructor
     """
 
-    def __init__(self, name, strict=False, make_executable=False):
-        # type: (str, bool, bool) -> None
+    def __init__(self, name, strict=False, make_executable=False, lock=False, lock_timeout=LOCK_TIMEOUT):
+        # type: (str, bool, bool, bool, float) -> None
         """Constructor.
 
         :param name: name of the file to operate on
         :param strict: a bool specifies the creatability
         :param make_executable: a bool specifies whether make the file executable or not (obviously)
+        :param lock: hold an exclusive advisory lock (flock) of the file until it's closed, so that other runs
+                     (that lock it too) wait for this one rather than racing it
+        :param lock_timeout: the seconds to wait for the lock, `ConcurrentModificationError' is raised after that
         """
 
+        # the file is opened once, everything is done through its file descriptor (`__del__' needs it even if the
+        # constructor fails)
+        self.fd = None
         if not name:
             raise ValueError("name can not be %r" % name)
 
         self.name = name
-        try:
-            self._extension = _re.findall("\.(.+)$", self.name)[0]
-        except IndexError:
-            self._extension = ''
-        self.contents = ''
+        self._extension = _extension_of(self.name)
+        # the raw bytes of the file (without the BOM), they're never decoded
+        self.contents = b''
+        self.bom = b''
+        self.newline = b'\n'
         self.created = False  # to delete it if we want to
+        # what's on the disk right now, used to skip writes that change nothing
+        self.original = b''
+        self.stat = None
+        # (old mode, new mode) once `make_executable' changes it
+        self.mode_change = None
 
-        if _os.path.exists(self.name):
-            if not _os.path.isfile(self.name):
-                raise ValueError("file name {!r} is not valid".format(self.name))
-
-            with open(self.name) as f:
-                self.contents = f.read()
-        else:
-            if strict:
-                raise ValueError("file name doesn't exist")
-            self.create()
+        self._write_error = None
+        self.lock = lock
+        self.lock_timeout = lock_timeout
+        self.open(strict)
 
         if make_executable:
             self.make_executable()
 
+    def open(self, strict=False):
+        # type: (bool) -> None
+        """Opens the file (creating it if it doesn't exist and not `strict') and reads it."""
+        # O_NONBLOCK so that a FIFO can't block us, it changes nothing for regular files
+        flags = _os.O_RDWR | _os.O_NONBLOCK | _os.O_NOCTTY | getattr(_os, "O_CLOEXEC", 0)
+        try:
+            self.fd = _os.open(self.name, flags)
+        except OSError as e:
+            if e.errno == _errno.ENOENT:
+                if strict:
+                    raise ValueError("file name doesn't exist")
+                self.create()
+                return
+            elif e.errno == _errno.EISDIR:
+                raise ValueError("file name {!r} is not valid".format(self.name))
+            elif e.errno in (_errno.EACCES, _errno.EPERM, _errno.EROFS, _errno.ETXTBSY):
+                # it still can be checked, `save' will tell that it can't be written
+                self._write_error = e
+                self.fd = _os.open(self.name, flags & ~_os.O_RDWR | _os.O_RDONLY)
+            else:
+                raise
+
+        try:
+            self.stat = _os.fstat(self.fd)
+            if not _stat.S_ISREG(self.stat.st_mode):
+                raise ValueError("file name {!r} is not valid".format(self.name))
+            if self.lock:
+                _lock_fd(self.fd, self.lock_timeout)
+                # whoever held the lock may have just written it
+                self.stat = _os.fstat(self.fd)
+
+            with _stats.phase("read", file=self.name):
+                self.original = _read_fd(self.fd, self.stat.st_size)
+        except BaseException:
+            self.close()
+            raise
+        _stats.count("bytes_read", len(self.original))
+        self._split(self.original)
+
+    def _split(self, data):
+        # type: (bytes) -> None
+        """Takes `data' as what's in the file, separating the BOM and finding out the line ending."""
+        self.original = self.contents = data
+        if self.contents.startswith(BOM):
+            self.bom, self.contents = BOM, self.contents[len(BOM):]
+
+        # the line ending used by the file, so that we don't mix them up
+        eol = self.contents.find(b'\n')
+        if eol > 0 and self.contents[eol - 1:eol] == b'\r':
+            self.newline = b'\r\n'
+
+    def close(self):
+        # type: () -> None
+        """Closes the file descriptor, nothing can be done with the file after that."""
+        if self.fd is not None:
+            _os.close(self.fd)
+            self.fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __del__(self):
+        self.close()
+
     def create(self):
         # type: () -> None
         """create an empty file of the object's name, setting self.created into True."""
+        self.fd = _os.open(self.name, _os.O_RDWR | _os.O_CREAT | _os.O_EXCL | getattr(_os, "O_CLOEXEC", 0), 0o666)
         self.created = True
-        with open(self.name, 'w') as f:
-            f.write('')
-
-    def save(self):
-        with open(self.name, 'w') as f:
-            f.write(self.contents)
+        try:
+            if self.lock:
+                _lock_fd(self.fd, self.lock_timeout)
+            self.stat = _os.fstat(self.fd)
+        except BaseException:
+            self.close()
+            raise
+
+    def save(self, preserve_mtime=False):
+        # type: (bool) -> bool
+        """Writes self.contents to the file, but only if they differ from what's already there.
+
+        The file is written only if it's still what has been read (the same inode, size and mtime, and still at its
+        name), it's a compare-and-swap against anyone who doesn't take the lock.
+
+        :param preserve_mtime: restore the original access and modification times after rewriting the file
+        :return: True -> the file has been rewritten
+                 False -> nothing changed, the file hasn't been touched
+        :raise ConcurrentModificationError: the file has been changed since it was read, read it again and retry
+        """
+        data = self.bom + self.contents
+        if data == self.original:
+            _stats.count("files_skipped")
+            return False
+        if self._write_error is not None:
+            raise self._write_error
+
+        with _stats.phase("write", file=self.name):
+            _check_unchanged(self.fd, self.name, self.stat)
+            _write_fd(self.fd, data)
+            self.original = data
+
+            if preserve_mtime:
+                _os.utime(self.fd, ns=(self.stat.st_atime_ns, self.stat.st_mtime_ns))
+            self.stat = _os.fstat(self.fd)
+        _stats.count("bytes_written", len(data))
+        _stats.count("files_rewritten")
+        return True
 
     def make_executable(self):
-        # type: () -> None
+        # type: () -> bool
         """change the stat of the object's file name to be executable
 
         Example:
              -rw-rw-rw- becomes -rwxrwxrwx
              -rw------ becomes -rwx------
+
+        :return: True -> the mode has been changed
+                 False -> the execute bits were already set, nothing done
         """
-        mode = _os.stat(self.name).st_mode
-        mode |= (mode & 0o444) >> 2
-        _os.chmod(self.name, mode)
+        mode = _os.fstat(self.fd).st_mode
+        new_mode = mode | (mode & 0o444) >> 2
+        if new_mode == mode:
+            return False
+
+        with _stats.phase("write", file=self.name):
+            _os.fchmod(self.fd, new_mode)
+        self.mode_change = (mode, new_mode)
+        return True
+
+
+class BufferFile(UnshebangedFile):
+    """An `UnshebangedFile' whose contents are given rather than read, the file system is never touched.
+
+    That's for editors and alike, which already have the file in memory:
+        >>> buf = BufferFile("file.py", "print(1)\\n")
+        >>> sf = ShebangedFile(buf, shebang="#!/usr/bin/python3\\n")
+        >>> sf.put_shebang()
+        0
+        >>> buf.text()
+        '#!/usr/bin/python3\\n\\nprint(1)\\n'
+    """
+
+    def __init__(self, name, contents):
+        # type: (str, str or bytes) -> None
+        """Constructor.
+
+        :param name: name of the file, only its extension is used
+        :param contents: what's in the file, a str is encoded as UTF-8 (and `text' decodes it back)
+        """
+        self.is_text = not isinstance(contents, bytes)
+        self._given = contents.encode('utf-8') if self.is_text else contents
+        super(BufferFile, self).__init__(name)
+
+    def open(self, strict=False):
+        # type: (bool) -> None
+        self._split(self._given)
+
+    def text(self):
+        # type: () -> str or bytes
+        """:return: the contents (with the BOM if any), of the same type as the given ones"""
+        data = self.bom + self.contents
+        return data.decode('utf-8') if self.is_text else data
+
+    def save(self, preserve_mtime=False):
+        # type: (bool) -> bool
+        """Nothing to write to.
+
+        :return: whether the contents differ from the given ones
+        """
+        return self.bom + self.contents != self._given
+
+    def make_executable(self):
+        # type: () -> bool
+        """A buffer has no mode to change."""
+        return False
 
 
 class ShebangedFile(object):
@@ -327,33 +758,75 @@ class ShebangedFile(object):
         #!/usr/bin/python
         <BLANKLINE>
         >>> sf.file.make_executable()
+        True
         >>> sf.shebang = "#!/usr/bin/ruby\\n"
         >>> sf.put_shebang()
         0
         >>> print(sf.shebang)
         #!/usr/bin/ruby
         <BLANKLINE>
-        >>> sf.file.save()        
+        >>> sf.file.save()
+        True
     """
 
     ALL_INTERS = _Data.load()
 
-    def __init__(self, unshebanged_file):
-        # type: (UnshebangedFile) -> None
+    def __init__(self, unshebanged_file, env=False, shebang=None):
+        # type: (UnshebangedFile, bool, str) -> None
         """Constructor.
         :param unshebanged_file: the file to add the shebang into
+        :param env: use '#!/usr/bin/env NAME' as the shebang, where NAME is the default interpreter of the extension,
+                    that doesn't look for anything on PATH
+        :param shebang: use this shebang (ending with a newline), nothing is looked for then
         """
         self.file = unshebanged_file
         try:
-            self.shebang = "#!{}\n".format(which(ShebangedFile.ALL_INTERS[self.file._extension]["default"]["name"])[0])
-        except (IndexError, KeyError):
+            if shebang is not None:
+                self.shebang = shebang
+            elif env:
+                self.shebang = ShebangedFile.env_shebang(file_name=self.file.name) + "\n"
+            else:
+                # only the first one is needed, the rest of PATH isn't looked at
+                self.shebang = "#!{}\n".format(
+                    next(_iter_which(ShebangedFile.ALL_INTERS[self.file._extension]["default"]["name"]))
+                )
+        except (StopIteration, KeyError, ShebangNotFoundError):
             self.shebang = ''
 
+    @staticmethod
+    def env_shebang(file_name=None, interpreter=None, args=None, must_exist=False):
+        # type: (str, str, str, bool) -> str
+        """Builds an '#!/usr/bin/env NAME' shebang straight from the known extensions, without looking at PATH.
+
+        :param file_name: the file name to get the extension from
+        :param interpreter: use this interpreter name rather than the default of the extension
+        :param args: arguments to be passed to the interpreter, they're put after 'env -S' (so that they get split)
+        :param must_exist: make sure that NAME is on PATH, that's a single lookup of the exact name
+        :return: the shebang, without the newline
+        """
+        if interpreter is None:
+            try:
+                default = ShebangedFile.ALL_INTERS[_extension_of(file_name or '')]["default"]
+            except KeyError:
+                raise ShebangNotFoundError("the file name extension is not associated with any known interpreter name")
+            interpreter = default["name"] + default["version"]
+
+        if must_exist and _lookup(interpreter) is None:
+            raise ShebangNotFoundError("interpreter %r is not found in this machine's PATH" % interpreter)
+
+        if args:
+            return "#!{} -S {} {}".format(ENV, interpreter, args)
+        return "#!{} {}".format(ENV, interpreter)
+
     def put_shebang(self, newline_count=1, overwrite=True):
         # type: (int, bool) -> int
-        """Puts the shebang on the first line of self.file plus ('\n' * newline_count).
-        
-        :param newline_count: number of '\n' appended after the shebang
+        """Puts the shebang on the first line of self.file plus (newline * newline_count).
+
+        The shebang line itself always ends with '\n' (the kernel doesn't like '\r' after the interpreter path),
+        the empty lines after it use the file's own line ending. A UTF-8 BOM is dropped as well, because the
+        shebang must be the very first bytes of the file to be of any use.
+
+        :param newline_count: number of newlines appended after the shebang
         :param overwrite: overwrite if it's a broken shebang
         :return: what check_shebang returns
         """
@@ -367,7 +840,8 @@ class ShebangedFile(object):
             else:
                 return code
 
-        self.file.contents = (self.shebang + '\n' * newline_count) + self.file.contents
+        self.file.contents = _to_bytes(self.shebang) + self.file.newline * newline_count + self.file.contents
+        self.file.bom = b''
         return 0
 
     def remove_shebang(self):
@@ -378,9 +852,10 @@ class ShebangedFile(object):
                  False - did nothing
         """
         con = self.file.contents  # just an alias
-        if con.startswith("#!"):
-            con = con[con.find('\n') + 1:]
-            self.file.contents = _re.sub("^\s*", '', con)
+        if con.startswith(b"#!"):
+            eol = con.find(b'\n')
+            con = con[eol + 1:] if eol != -1 else b''
+            self.file.contents = con.lstrip()
             return True
 
         return False
@@ -396,14 +871,25 @@ class ShebangedFile(object):
         """
 
         con = self.file.contents
-        if con.startswith(self.shebang[:-1]):
-            return 1
+        if not con.startswith(b"#!"):
+            return 0
 
-        elif con.startswith("#!"):
+        # a shebang behind a BOM is never read by the kernel
+        if self.file.bom:
             return 2
+        if con.startswith(_to_bytes(self.shebang).rstrip(b'\n')):
+            return 1
 
-        return 0
+        # the same interpreter with the same flags, however they're written ('-Es', '-s -E' or through 'env -S')
+        eol = con.find(b'\n')
+        line = con[:eol] if eol != -1 else con
+        # (bytes are str already on Python 2)
+        if _command_of(line if isinstance(line, str) else _os.fsdecode(line)) == _command_of(self.shebang):
+            return 1
 
+        return 2
+
+    @_stats.timed("resolution")
     def get_extension(self=None, file_name=None, interpreter=None, get_versions=False, get_links=0):
         # type: (str, str, bool, int) -> Extension
         """Get the extension of the file.
@@ -463,9 +949,8 @@ class ShebangedFile(object):
 
         # that means that interpreter wasn't 'found' or it wasn't set
         if not pref_inter:
-            try:
-                extension = _re.findall("\.(.+)$", file_name)[0]
-            except IndexError:
+            extension = _extension_of(file_name)
+            if not extension:
                 # couldn't find the extension in the file file_name, if we have the interpreter, just grab it and
                 # its versions if required
                 # NOTE: we won't do anything about links now, may be I should think of that
@@ -482,6 +967,7 @@ class ShebangedFile(object):
                         if get_versions:
                             for path in which(pref_inter["name"] + '*'):
                                 if _re.match(version_regex % pref_inter["name"], _os.path.basename(path)):
+                                    _stats.count("regex_matches")
                                     inter.paths.append(InterpreterPath(path))
 
                         ext = Extension('', interpreters={"default": None, "others": [inter]})
@@ -500,6 +986,10 @@ class ShebangedFile(object):
         others = [Interpreter(extension=extension, **i) for i in others]
         interpreters = {"default": default, "others": others}
 
+        # the interpreters of the nearest virtualenv are offered first, and any version of them is the default
+        venv = _venv_of(file_name)
+        venv_regex = version_regex
+
         if not get_versions:
             # we don't need it's function, so None it.
             version_regex = ''
@@ -514,9 +1004,12 @@ class ShebangedFile(object):
 
             seedefault = True
             seeprefered = pref_inter != {}
-            for path in which(inter.name + "*"):
+            venv_paths = _VenvFinder.current.which(venv, inter.name + "*") if venv else []
+            for path in venv_paths + which(inter.name + "*"):
                 executable = _os.path.basename(path)
-                if seedefault and inter_regex.match(executable):
+                if seedefault and (inter_regex.match(executable) or
+                                   path in venv_paths and _re.match(venv_regex % inter.name, executable)):
+                    _stats.count("regex_matches")
                     if inter == interpreters["default"]:
                         defpath = InterpreterPath(path, default_for_inter=True, default_for_ext=True)
                     else:
@@ -525,9 +1018,11 @@ class ShebangedFile(object):
                     seedefault = False
                 elif seeprefered and _re.match(found_regex.format(pref_inter["name"], pref_inter["version"]),
                                                executable):
+                    _stats.count("regex_matches")
                     inter.paths.append(InterpreterPath(path, default_for_file=True))
                     seeprefered = False
                 elif version_regex and _re.match(version_regex % inter.name, executable):
+                    _stats.count("regex_matches")
                     inter.paths.append(InterpreterPath(path))
         # =========================================================================
 
@@ -552,6 +1047,37 @@ class ShebangedFile(object):
 
         return Extension(name=extension, interpreters=interpreters)
 
+    @staticmethod
+    def iter_known(get_links):
+        """Yields a dict for every path of every known interpreter, as soon as its extension is resolved.
+
+        It's the raw data of `print_known', the records look like:
+            {"extension": "py", "interpreter": "python", "path": "/usr/bin/python3.6",
+             "realpath": "/usr/bin/python3.6", "link": False, "default": "extension"}
+        where "default" is one of "extension", "interpreter" or None, an interpreter that isn't found gets a single
+        record with a None "path".
+
+        :param get_links: the same as in `print_known'
+        """
+        for ext in ShebangedFile.ALL_INTERS.keys():
+            extension = ShebangedFile.get_extension(file_name="file." + ext, get_versions=True, get_links=get_links)
+            inters = extension.interpreters
+            for i in [inters["default"]] + inters["others"]:
+                record = {"extension": extension.name, "interpreter": i.name, "path": None, "realpath": None,
+                          "link": False, "default": None}
+                paths = i.all_paths
+                if not paths:
+                    yield record
+                for p in paths:
+                    default = None
+                    if i.default and p.default_for_ext:
+                        default = "extension"
+                    elif p.default_for_inter:
+                        default = "interpreter"
+                    r = record.copy()
+                    r.update(path=p.path, realpath=p.realpath, link=p.islink, default=default)
+                    yield r
+
     @staticmethod
     def print_known(get_links, format='tree'):
         """Prints a nice formatted string of known interpreters.
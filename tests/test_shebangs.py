@@ -3,11 +3,24 @@
 
 """Tests for `putshebang` package."""
 
+import errno
+import json
+import os
+import threading
+import time
 import unittest
+from unittest import mock
+from contextlib import redirect_stdout
+from io import StringIO
 
-from putshebang import shebang, which
+from putshebang import shebang, shebang_buffer, iter_shebangs, which, stats, ShebangedFile, UnshebangedFile, \
+    ConcurrentModificationError
 from putshebang import cli as cli
-from tempfile import gettempdir
+from putshebang import _discovery, shebangs
+from putshebang.shebangs import _extension_of
+from putshebang._suffix import SuffixTrie
+from shutil import rmtree
+from tempfile import gettempdir, mkdtemp
 from os.path import join
 
 
@@ -17,3 +30,642 @@ class TestPutshebang(unittest.TestCase):
     def test_command_line_interface(self):
         assert cli.main(["-l", "python", join(gettempdir(), "file.py")]) == 0
         assert "#!" + which("python")[0] in shebang("tmp.py", get_versions=True)
+
+
+class TestUnshebangedFile(unittest.TestCase):
+    """Tests for the file pipeline."""
+
+    def setUp(self):
+        self.dir = mkdtemp()
+        self.name = join(self.dir, "file.py")
+
+    def tearDown(self):
+        rmtree(self.dir)
+
+    def test_save_skips_unchanged_contents(self):
+        with open(self.name, "w") as f:
+            f.write("#!/usr/bin/python\n\nprint(1)\n")
+        os.utime(self.name, (1000, 1000))
+
+        uf = UnshebangedFile(self.name)
+        assert not uf.save()
+        assert os.stat(self.name).st_mtime == 1000
+
+        uf.contents = b"print(2)\n"
+        assert uf.save(preserve_mtime=True)
+        assert os.stat(self.name).st_mtime == 1000
+        with open(self.name) as f:
+            assert f.read() == "print(2)\n"
+
+    def test_bytes_are_kept_as_they_are(self):
+        body = b"# caf\xe9\r\nprint(1)\r\n"
+        with open(self.name, "wb") as f:
+            f.write(b"\xef\xbb\xbf" + body)
+
+        sf = ShebangedFile(UnshebangedFile(self.name))
+        sf.shebang = "#!/usr/bin/python\n"
+        assert sf.check_shebang() == 0
+        assert sf.put_shebang() == 0
+        assert sf.file.save()
+        with open(self.name, "rb") as f:
+            assert f.read() == b"#!/usr/bin/python\n\r\n" + body
+
+        sf = ShebangedFile(UnshebangedFile(self.name))
+        sf.shebang = "#!/usr/bin/python\n"
+        assert sf.check_shebang() == 1
+
+    def test_make_executable_skips_chmod(self):
+        with open(self.name, "w") as f:
+            f.write("")
+        os.chmod(self.name, 0o644)
+
+        uf = UnshebangedFile(self.name)
+        assert uf.make_executable()
+        assert os.stat(self.name).st_mode & 0o777 == 0o755
+        assert not uf.make_executable()
+
+    def test_file_descriptor(self):
+        self.assertRaises(ValueError, UnshebangedFile, "")
+        self.assertRaises(ValueError, UnshebangedFile, self.dir)
+        self.assertRaises(ValueError, UnshebangedFile, self.name, strict=True)
+
+        with UnshebangedFile(self.name) as uf:
+            assert uf.created and uf.fd is not None
+            uf.contents = b"print(1)\n"
+            assert uf.save()
+            uf.contents = b"1\n"
+            assert uf.save()
+        assert uf.fd is None
+        with open(self.name, "rb") as f:
+            assert f.read() == b"1\n"
+
+    def test_concurrent_writes(self):
+        with open(self.name, "w") as f:
+            f.write("print(1)\n")
+
+        # someone else writes it in between
+        uf = UnshebangedFile(self.name)
+        uf.contents = b"print(2)\n"
+        with open(self.name, "w") as f:
+            f.write("print(10)\n")
+        self.assertRaises(ConcurrentModificationError, uf.save)
+        # or replaces it
+        uf = UnshebangedFile(self.name)
+        uf.contents = b"print(2)\n"
+        with open(self.name + ".tmp", "w") as f:
+            f.write("print(11)\n")
+        os.rename(self.name + ".tmp", self.name)
+        self.assertRaises(ConcurrentModificationError, uf.save)
+        with open(self.name) as f:
+            assert f.read() == "print(11)\n"
+
+        # whoever locks it waits for the one holding the lock, and reads what it has written
+        stats.reset()
+        holder = UnshebangedFile(self.name, lock=True)
+        opened = []
+        waiter = threading.Thread(target=lambda: opened.append(UnshebangedFile(self.name, lock=True)))
+        waiter.start()
+        time.sleep(0.1)
+        assert not opened
+        holder.contents = b"print(3)\n"
+        assert holder.save()
+        holder.close()
+        waiter.join()
+        assert opened[0].original == b"print(3)\n"
+        assert stats.counters["lock_waits"] == 1
+        opened[0].contents = b"print(4)\n"
+        assert opened[0].save()
+
+        # a file system without locks is left to the checks before writing
+        with mock.patch.object(shebangs._fcntl, "flock", side_effect=OSError(errno.ENOLCK, "No locks available")):
+            uf = UnshebangedFile(self.name, lock=True)
+        uf.contents = b"print(5)\n"
+        assert uf.save()
+
+    def test_stats_hook(self):
+        calls = []
+        hook = lambda phase, seconds, info: calls.append((phase, info))
+        stats.reset()
+        stats.add_hook(hook)
+        try:
+            with open(self.name, "wb") as f:
+                f.write(b"print(1)\n")
+            uf = UnshebangedFile(self.name)
+            uf.contents = b"print(2)\n"
+            uf.save()
+            assert not uf.save()
+        finally:
+            stats.remove_hook(hook)
+
+        assert calls == [("read", {"file": self.name}), ("write", {"file": self.name})]
+        assert stats.counters["bytes_read"] == stats.counters["bytes_written"] == 9
+        assert stats.counters["files_rewritten"] == stats.counters["files_skipped"] == 1
+
+
+class FakePathTestCase(unittest.TestCase):
+    """Runs the tests on a PATH of our own."""
+
+    def setUp(self):
+        self.dir = mkdtemp()
+        self.bin = join(self.dir, "bin")
+        os.mkdir(self.bin)
+        for name in ("python3.6", "python2.7", "bash", "sh"):
+            with open(join(self.bin, name), "w") as f:
+                f.write("")
+            os.chmod(join(self.bin, name), 0o755)
+        self.path = os.environ.get("PATH")
+        os.environ["PATH"] = self.bin
+
+    def tearDown(self):
+        os.environ["PATH"] = self.path
+        rmtree(self.dir)
+
+
+class TestShebang(FakePathTestCase):
+    """Tests for the `shebang' function."""
+
+    def test_cache(self):
+        stats.reset()
+        assert shebang("file.php") == []
+        assert shebang("other.php") == []
+        assert stats.counters["cache_hits"] == 1
+
+        with open(join(self.bin, "php"), "w") as f:
+            f.write("")
+        os.chmod(join(self.bin, "php"), 0o755)
+        assert shebang("file.php") == ["#!" + join(self.bin, "php")]
+        assert stats.counters["cache_misses"] == 2
+
+    def test_chmod(self):
+        # a chmod doesn't change the mtime of the directory, neither the listings nor the cache may miss it
+        with open(join(self.bin, "ruby"), "w") as f:
+            f.write("")
+        assert which("ruby") == [] and shebang("file.rb") == []
+        os.chmod(join(self.bin, "ruby"), 0o755)
+        assert which("ruby") == [join(self.bin, "ruby")]
+        assert shebang("file.rb") == ["#!" + join(self.bin, "ruby")]
+
+        os.chmod(join(self.bin, "ruby"), 0o644)
+        assert which("ruby") == [] and shebang("file.rb") == []
+        assert next(iter_shebangs("file.rb"), None) is None
+
+    def test_env_must_exist(self):
+        other = join(self.dir, "other")
+        os.mkdir(other)
+        for name in ("perl", "ruby", "node"):
+            with open(join(other, name), "w") as f:
+                f.write("")
+            os.chmod(join(other, name), 0o755)
+        os.environ["PATH"] = other + ":" + self.bin
+
+        # nothing is listed, that's a stat per directory as far as the one that has it
+        stats.reset()
+        with mock.patch.object(_discovery.PathLister, "current", _discovery.PathLister()):
+            assert ShebangedFile.env_shebang(interpreter="bash", must_exist=True) == "#!/usr/bin/env bash"
+            with self.assertRaises(shebangs.ShebangNotFoundError):
+                ShebangedFile.env_shebang(interpreter="zsh", must_exist=True)
+        assert stats.counters["lstat_calls"] == 4
+        assert stats.counters.get("dirs_scanned", 0) == 0
+
+    def test_slow_path(self):
+        stalled = join(self.dir, "stalled")
+        os.mkdir(stalled)
+        mounted = threading.Event()
+        list_executables = _discovery._list_executables
+
+        def listing(d):
+            if d == stalled:
+                mounted.wait()
+            return list_executables(d)
+
+        lister = _discovery.PathLister(timeout=0.1)
+        with mock.patch.object(_discovery, "_list_executables", listing):
+            assert [d for d, names in lister.listings([stalled, self.bin])] == [self.bin]
+            assert lister.slow == {stalled}
+
+            # it's skipped without waiting from then on
+            start = time.time()
+            assert [d for d, names in lister.listings([stalled, self.bin])] == [self.bin]
+            assert time.time() - start < 0.1
+
+            mounted.set()
+            lister._pending[stalled].done.wait()
+            assert [d for d, names in lister.listings([stalled, self.bin])] == [stalled, self.bin]
+            assert not lister.slow
+
+        # a known directory that stalls later on doesn't block the lookups (nor the fingerprint) either
+        mounted.clear()
+        refresh = _discovery._refresh
+
+        def stat(d, known):
+            if d == stalled:
+                mounted.wait()
+            return refresh(d, known)
+
+        with mock.patch.object(_discovery, "_refresh", stat):
+            start = time.time()
+            assert lister.fingerprint([stalled, self.bin])[0] == "slow"
+            assert [d for d, names in lister.listings([stalled, self.bin])] == [self.bin]
+            assert time.time() - start < 0.5
+            mounted.set()
+
+    def test_iter_shebangs(self):
+        other = join(self.dir, "other")
+        os.mkdir(other)
+        for name in ("python3.6", "python3.7", "pypy3"):
+            with open(join(other, name), "w") as f:
+                f.write("")
+            os.chmod(join(other, name), 0o755)
+        os.environ["PATH"] = self.bin + ":" + other
+
+        stats.reset()
+        assert next(iter_shebangs("file.py")) == "#!" + join(self.bin, "python3.6")
+        assert stats.counters["dirs_scanned"] == 1
+
+        assert list(iter_shebangs("file.py")) == ["#!" + join(self.bin, "python3.6"), "#!" + join(other, "pypy3")]
+        assert list(iter_shebangs("file.py", interpreter="python3.7", get_versions=True)) == [
+            "#!" + join(other, p) for p in ("python3.7", "python3.6")] + [
+            "#!" + join(self.bin, p) for p in ("python3.6", "python2.7")] + ["#!" + join(other, "pypy3")]
+
+    def test_dotted_names(self):
+        assert "#!" + join(self.bin, "python3.6") in shebang(join(self.dir + ".d", "deploy.prod.py"))
+        assert _extension_of("archive.tar.gz") == "gz" and _extension_of("dir.d/file") == ""
+
+        trie = SuffixTrie(["sh", "test.sh", "py"])
+        assert [trie.longest(n) for n in ("x.test.sh", "x.prod.sh", "xtest.sh", "happy", ".py")] == \
+            ["test.sh", "sh", "sh", None, "py"]
+
+    def test_buffer(self):
+        python = join(self.bin, "python3.6")
+        result = shebang_buffer(join(self.dir, "new.py"), "print(1)\r\n")
+        assert result == {"contents": "#!%s\n\r\nprint(1)\r\n" % python, "status": 0, "interpreter": python}
+        assert not os.path.exists(join(self.dir, "new.py"))
+
+        result = shebang_buffer("file.py", result["contents"].encode(), check=True)
+        assert result["status"] == 1
+        result = shebang_buffer("file.py", b"#!/usr/bin/python2\nprint(1)\n", interpreter="bash")
+        assert result["contents"] == b"#!%s\n\nprint(1)\n" % join(self.bin, "bash").encode()
+        assert result["status"] == 2
+        # the asked for one, even though it's not the first one by its path
+        result = shebang_buffer("file.py", "x\n", interpreter="python2.7")
+        assert result["interpreter"] == join(self.bin, "python2.7")
+
+
+class TestCommandLine(FakePathTestCase):
+    """Tests for the command line interface."""
+
+    def run_json(self, args):
+        out = StringIO()
+        with redirect_stdout(out):
+            rs = cli.main(["-f", "jsonl"] + args)
+        return rs, [json.loads(l) for l in out.getvalue().splitlines()]
+
+    def test_jsonl_records(self):
+        name = join(self.dir, "file.py")
+        rs, records = self.run_json([name, name, join(self.dir, "file")])
+        assert rs == 1
+        assert [r["status"] for r in records] == ["written", "correct", "failed"]
+        assert records[0]["shebang"] == "#!" + join(self.bin, "python3.6")
+
+        rs, records = self.run_json(["-k", "tree"])
+        assert {"extension": "py", "interpreter": "python", "path": join(self.bin, "python3.6"),
+                "realpath": join(self.bin, "python3.6"), "link": False, "default": "extension"} in records
+
+    def test_env(self):
+        stats.reset()
+        rs, records = self.run_json(["-e", "-A=-u", join(self.dir, "file.py"), join(self.dir, "file.rb")])
+        assert rs == 0
+        assert [r["shebang"] for r in records] == ["#!/usr/bin/env -S python3.6 -u", "#!/usr/bin/env -S ruby -u"]
+        assert stats.counters["dirs_scanned"] == 0
+
+        rs, records = self.run_json(["-e", "-m", join(self.dir, "file.py"), join(self.dir, "file.rb")])
+        assert [r["status"] for r in records] == ["wrong", "failed"]
+
+    def test_inventory(self):
+        os.symlink(join(self.bin, "python3.6"), join(self.bin, "python3"))
+        inventory = join(self.dir, "inventory.json")
+        assert cli.main(["--export-inventory", inventory]) == 0
+
+        os.environ["PATH"] = self.dir
+        rs, records = self.run_json(["--inventory", inventory, "-F", "2", join(self.dir, "file.py")])
+        assert records[0]["shebang"] == "#!" + join(self.bin, "python3.6")
+
+        rs, records = self.run_json(["--inventory", inventory, "-k", "tree"])
+        link = [r for r in records if r["path"] == join(self.bin, "python3")][0]
+        assert link["link"] and link["realpath"] == join(self.bin, "python3.6")
+
+    def test_root(self):
+        root = join(self.dir, "root")
+        os.makedirs(join(root, "usr", "bin"))
+        os.rename(join(self.bin, "python3.6"), join(root, "usr", "bin", "python3.6"))
+        os.symlink("/usr/bin/python3.6", join(root, "usr", "bin", "python3"))
+        os.symlink("usr/bin", join(root, "bin"))
+
+        os.environ["PATH"] = "/usr/bin:/bin"
+        rs, records = self.run_json(["--root", root, "-d", join(self.dir, "file.py")])
+        assert records[0]["shebang"] == "#!/usr/bin/python3.6"
+
+        rs, records = self.run_json(["--root", root, "-k", "tree"])
+        paths = {r["path"]: (r["link"], r["realpath"]) for r in records if r["interpreter"] == "python"}
+        assert paths == {"/usr/bin/python3.6": (False, "/usr/bin/python3.6"),
+                         "/usr/bin/python3": (True, "/usr/bin/python3.6"),
+                         "/bin/python3.6": (False, "/usr/bin/python3.6"),
+                         "/bin/python3": (True, "/usr/bin/python3.6")}
+
+    def test_jobs(self):
+        names = [join(self.dir, "file%d.%s" % (i, ext)) for i in range(20) for ext in ("py", "sh", "txt")]
+        for name in names:
+            with open(name, "w") as f:
+                f.write("x\n")
+        os.link(names[0], join(self.dir, "link.py"))
+
+        rs, records = self.run_json(["-j", "4", "--max-inflight", "0"] + names + [join(self.dir, "link.py")])
+        assert [r["file"] for r in records] == names + [join(self.dir, "link.py")]
+        assert [r["status"] for r in records] == ["written", "written", "failed"] * 20 + ["duplicate"]
+        # the same as without -j
+        os.link(names[3], join(self.dir, "link2.py"))
+        rs, records = self.run_json([names[3], join(self.dir, "link2.py")])
+        assert [r["status"] for r in records] == ["correct", "duplicate"]
+
+        contents = []
+        for name in names:
+            with open(name) as f:
+                contents.append(f.read())
+        rs, records = self.run_json(["-j", "4"] + names)
+        assert [r["status"] for r in records] == ["correct", "correct", "failed"] * 20
+        for name, expected in zip(names, contents):
+            with open(name) as f:
+                assert f.read() == expected
+
+    def test_journal(self):
+        journal = join(self.dir, "journal")
+        names = [join(self.dir, n) for n in ("a.py", "b.py", "c.py", "new.py")]
+        contents = [b"print(1)\r\n", b"#!/usr/bin/python2\n\nprint(2)\n", b"\xef\xbb\xbfprint(3)\n"]
+        for name, data in zip(names, contents):
+            with open(name, "wb") as f:
+                f.write(data)
+            os.chmod(name, 0o644)
+
+        rs, records = self.run_json(["-d", "-o", "-x", "-J", journal] + names)
+        assert [r["status"] for r in records] == ["written"] * 4
+
+        rs, records = self.run_json(["--undo", journal])
+        assert [r["status"] for r in records] == ["restored"] * 4
+        for name, data in zip(names, contents):
+            with open(name, "rb") as f:
+                assert f.read() == data
+            assert os.stat(name).st_mode & 0o777 == 0o644
+        assert not os.path.exists(names[-1])
+
+    def test_rewrite(self):
+        journal = join(self.dir, "journal")
+        table = join(self.dir, "table.json")
+        with open(table, "w") as f:
+            json.dump({"/usr/bin/python2*": "/usr/bin/env python3"}, f)
+        names = [join(self.dir, n) for n in ("a.py", "b.py", "c.sh", "d")]
+        contents = [b"#!/usr/bin/python2.7\r\nprint(1)\r\n", b"#!/usr/bin/python\nprint(2)\n",
+                    b"#!/usr/local/bin/bash -e\nexit\n", b"#!/usr/bin/python2\n"]
+        for name, data in zip(names, contents):
+            with open(name, "wb") as f:
+                f.write(data)
+
+        rs, records = self.run_json(["-R", table, "-M", "/usr/local/bin/bash*=/bin/bash -e", "-J", journal] + names)
+        assert [r["status"] for r in records] == ["written", "unchanged", "written", "written"]
+        with open(names[0], "rb") as f:
+            assert f.read() == b"#!/usr/bin/env python3\nprint(1)\r\n"
+        with open(names[2], "rb") as f:
+            assert f.read() == b"#!/bin/bash -e\nexit\n"
+
+        self.run_json(["--undo", journal])
+        for name, data in zip(names, contents):
+            with open(name, "rb") as f:
+                assert f.read() == data
+
+        # a file that doesn't match is only read, and a FIFO isn't read at all
+        os.chmod(names[1], 0o444)
+        fifo = join(self.dir, "fifo")
+        os.mkfifo(fifo)
+        rs, records = self.run_json(["-R", table, names[1], fifo])
+        assert [r["status"] for r in records] == ["unchanged", "failed"]
+
+    def test_providers(self):
+        pyenv = join(self.dir, "pyenv")
+        os.makedirs(join(pyenv, "versions", "3.9.1", "bin"))
+        python = join(pyenv, "versions", "3.9.1", "bin", "python3.9")
+        with open(python, "w") as f:
+            f.write("")
+        os.chmod(python, 0o755)
+        os.environ.update(PYENV_ROOT=pyenv, XDG_CACHE_HOME=join(self.dir, "cache"))
+        try:
+            stats.reset()
+            rs, records = self.run_json(["-P", "pyenv", "-k", "tree"])
+            assert python in [r["path"] for r in records]
+            assert os.path.exists(join(self.dir, "cache", "putshebang", "providers.json"))
+
+            # the next run starts from the cache file, nothing is listed again
+            stats.reset()
+            self.run_json(["-P", "pyenv", "-k", "tree"])
+            assert stats.counters["dirs_scanned"] == 0
+
+            os.makedirs(join(pyenv, "versions", "3.10.0", "bin"))
+            os.rename(python, join(pyenv, "versions", "3.10.0", "bin", "python3.10"))
+            rs, records = self.run_json(["-P", "all", "-d", join(self.dir, "file.py"), "-l", "python3.10"])
+            assert records[0]["shebang"] == "#!" + join(pyenv, "versions", "3.10.0", "bin", "python3.10")
+        finally:
+            del os.environ["PYENV_ROOT"], os.environ["XDG_CACHE_HOME"]
+
+    def test_venv(self):
+        project = join(self.dir, "project")
+        os.makedirs(join(project, ".venv", "bin"))
+        with open(join(project, ".venv", "pyvenv.cfg"), "w") as f:
+            f.write("")
+        for name in ("python", "python3", "python3.11"):
+            with open(join(project, ".venv", "bin", name), "w") as f:
+                f.write("")
+            os.chmod(join(project, ".venv", "bin", name), 0o755)
+        names = [join(project, "service", d, "file%d.py" % i) for d in ("a", "b") for i in range(3)]
+        for d in ("a", "b"):
+            os.makedirs(join(project, "service", d))
+
+        stats.reset()
+        rs, records = self.run_json(["-V", "-d", join(self.dir, "file.py")] + names)
+        assert records[0]["shebang"] == "#!" + join(self.bin, "python3.6")
+        assert {r["shebang"] for r in records[1:]} == {"#!" + join(project, ".venv", "bin", "python")}
+        # self.dir, its ancestors, service/a, service/b, service and project
+        assert stats.counters["venv_dirs_checked"] == len(self.dir.split("/")) + 4
+
+    def test_check_state(self):
+        state = join(self.dir, "state")
+        names = [join(self.dir, n) for n in ("a.py", "b.py", "c.py", "d.sh")]
+        contents = [b"print(1)\n", b"#!%s\nprint(2)\n" % join(self.bin, "python3.6").encode(),
+                    b"#!/usr/bin/python2\n", b"#!/bin/sh\n"]
+        for name, data in zip(names, contents):
+            with open(name, "wb") as f:
+                f.write(data)
+
+        stats.reset()
+        rs, records = self.run_json(["-c", "--state", state] + names)
+        assert rs == 1
+        assert [r["status"] for r in records] == ["missing", "correct", "wrong", "wrong"]
+        assert stats.counters["bytes_read"] == sum(map(len, contents))
+        for name, data in zip(names, contents):
+            with open(name, "rb") as f:
+                assert f.read() == data
+
+        # a new python comes first on PATH
+        new_bin = join(self.dir, "new_bin")
+        os.mkdir(new_bin)
+        os.rename(join(self.bin, "python3.6"), join(new_bin, "python3.6"))
+        os.environ["PATH"] = new_bin + ":" + self.bin
+        with open(names[0], "wb") as f:
+            f.write(b"#!%s\n\nprint(1)\n" % join(new_bin, "python3.6").encode())
+        stats.reset()
+        rs, records = self.run_json(["-c", "--state", state, "-j", "2"] + names)
+        assert [r["status"] for r in records] == ["correct", "wrong", "wrong", "wrong"]
+        assert stats.counters["cache_hits"] == 1
+
+        # the same size and the same mtime (as -p leaves it), but not the same contents
+        st = os.stat(names[3])
+        with open(names[3], "wb") as f:
+            f.write(b"print(3)\n\n")
+        os.utime(names[3], ns=(st.st_atime_ns, st.st_mtime_ns))
+        rs, records = self.run_json(["-c", "--state", state] + names)
+        assert [r["status"] for r in records] == ["correct", "wrong", "wrong", "missing"]
+
+        # only the header is read
+        with open(names[1], "ab") as f:
+            f.write(b"#" * 10000 + b"\n")
+        stats.reset()
+        rs, records = self.run_json(["-c", names[1]])
+        assert records[0]["status"] == "wrong"
+        assert stats.counters["bytes_read"] == 512
+
+    def test_shard(self):
+        names = [join(self.dir, "file%d.py" % i) for i in range(30)]
+        cwd = os.getcwd()
+        os.chdir(self.dir)
+        try:
+            reports = []
+            for i in range(1, 4):
+                rs, records = self.run_json(["--shard", "%d/3" % i, "-c"] + names[::-1])
+                assert 0 < len(records) < 30
+                assert [r["file"] for r in records] == [n for n in names[::-1] if n in {r["file"] for r in records}]
+                reports.append(join(self.dir, "report%d" % i))
+                with open(reports[-1], "w") as f:
+                    f.writelines(json.dumps(r) + "\n" for r in records)
+
+            # the split doesn't depend on the order of the files, nor on how their paths are given
+            rs, records = self.run_json(["--shard", "1/3", "-c"] + [os.path.basename(n) for n in names])
+            with open(reports[0]) as f:
+                assert [join(self.dir, r["file"]) for r in records] == [json.loads(l)["file"] for l in f][::-1]
+        finally:
+            os.chdir(cwd)
+
+        rs, records = self.run_json(["--merge"] + reports)
+        assert rs == 1
+        assert records[0]["files"] == 30 and records[0]["status"] == {"failed": 30}
+        assert [r["file"] for r in records[0]["problems"]] == sorted(names)
+
+    def test_lockfile(self):
+        lock = join(self.dir, "lock")
+        names = [join(self.dir, n) for n in ("a.py", "b.py", "c.sh")]
+        rs, records = self.run_json(["-L", lock, "-l", "python2.7"] + names[:2])
+        assert {r["shebang"] for r in records} == {"#!" + join(self.bin, "python2.7")}
+        with open(lock, "a") as f:
+            f.write(json.dumps({"glob": "*.sh", "shebang": "#!/bin/dash"}) + "\n")
+        for name in names:
+            with open(name, "w") as f:
+                f.write("x\n")
+
+        # no PATH at all, it all comes from the lock
+        os.environ["PATH"] = ""
+        stats.reset()
+        rs, records = self.run_json(["-L", lock, "-c"] + names)
+        python = "#!" + join(self.bin, "python2.7")
+        assert [(r["status"], r["shebang"]) for r in records] == [("missing", python)] * 2 + [
+            ("missing", "#!/bin/dash")]
+        rs, records = self.run_json(["-L", lock] + names)
+        assert [r["status"] for r in records] == ["written"] * 3
+        assert stats.counters["dirs_scanned"] == 0
+        with open(lock) as f:
+            entries = [json.loads(l) for l in f]
+        assert entries[0] == {"file": "a.py", "interpreter": "python2.7", "shebang": python}
+        assert len(entries) == 3
+
+    def test_conflicts(self):
+        name = join(self.dir, "file.py")
+        conflict = ConcurrentModificationError(11, "the file has been modified since it was read", name)
+
+        stats.reset()
+        with mock.patch.object(shebangs, "_check_unchanged", side_effect=[conflict, None]):
+            rs, records = self.run_json([name])
+        assert rs == 0 and records[0]["status"] == "written"
+        assert stats.counters["conflicts"] == 1
+
+        with open(name, "w") as f:
+            f.write("x\n")
+        with mock.patch.object(shebangs, "_check_unchanged", side_effect=conflict):
+            rs, records = self.run_json(["--retries", "1", name])
+        assert rs == 1 and records[0]["status"] == "conflict"
+        with open(name) as f:
+            assert f.read() == "x\n"
+
+        # the shebang is resolved once, before the file is locked, and the lock is waited for only so long
+        choose_path = mock.Mock(wraps=cli.choose_path)
+        with UnshebangedFile(name, lock=True), mock.patch.object(cli, "choose_path", choose_path):
+            start = time.time()
+            rs, records = self.run_json(["--lock-timeout", "0.1", "--retries", "2", name])
+            assert time.time() - start < 1
+        assert rs == 1 and records[0]["status"] == "conflict"
+        assert choose_path.call_count == 1
+        with open(name) as f:
+            assert f.read() == "x\n"
+
+    def test_flags(self):
+        py, sh = join(self.dir, "file.py"), join(self.dir, "file.bash")
+        rs, records = self.run_json(["--flags", "startup", py, sh])
+        assert [r["shebang"] for r in records] == [
+            "#!{} -Es".format(join(self.bin, "python3.6")),
+            "#!/usr/bin/env -S {} --noprofile --norc".format(join(self.bin, "bash"))]
+        rs, records = self.run_json(["--flags", "startup", py, sh])
+        assert [r["status"] for r in records] == ["correct"] * 2
+
+        # the same flags, written otherwise
+        with open(py, "w") as f:
+            f.write("#!/usr/bin/env -S {} -s -E\n".format(join(self.bin, "python3.6")))
+        with open(sh, "w") as f:
+            f.write("#!{}\n".format(join(self.bin, "bash")))
+        rs, records = self.run_json(["-c", "--flags", "startup", py, sh])
+        assert [r["status"] for r in records] == ["correct", "wrong"]
+        rs, records = self.run_json(["-c", py, sh])
+        assert [r["status"] for r in records] == ["wrong", "correct"]
+
+        assert shebang_buffer("x.py", "1\n", env=True, flags="startup")["contents"] == \
+            "#!/usr/bin/env -S python3.6 -Es\n\n1\n"
+
+    def test_prefer(self):
+        for name, body in (("python3.6", "sleep 0.2\n"), ("python2.7", "")):
+            with open(join(self.bin, name), "w") as f:
+                f.write("#!/bin/sh\n" + body)
+        os.environ["XDG_CACHE_HOME"] = self.dir
+        try:
+            name = join(self.dir, "file.py")
+            stats.reset()
+            rs, records = self.run_json(["--prefer", "fastest-startup", name])
+            assert records[0]["shebang"] == "#!" + join(self.bin, "python2.7")
+            assert stats.counters["interpreters_timed"] == 2
+
+            # the timings are kept, only what's changed is timed again
+            os.utime(join(self.bin, "python2.7"), (1000, 1000))
+            stats.reset()
+            rs, records = self.run_json(["-c", "--prefer", "fastest-startup", name])
+            assert records[0]["status"] == "correct"
+            assert stats.counters["interpreters_timed"] == 1
+
+            # the interpreters of an image can't be timed here
+            stats.reset()
+            with self.assertRaises(SystemExit):
+                self.run_json(["--prefer", "fastest-startup", "--root", self.dir, name])
+            assert not stats.counters.get("interpreters_timed")
+        finally:
+            del os.environ["XDG_CACHE_HOME"]